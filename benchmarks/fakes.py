@@ -0,0 +1,309 @@
+# Local stand-ins for the Jamf, Zentral and AWS secrets extension HTTP APIs
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+
+class FakeFleet:
+    def __init__(self, size, profile_uuid, taxonomy, ready_tag):
+        self.profile_uuid = profile_uuid
+        self.taxonomy = taxonomy
+        self.serial_numbers = [f"NEKO{i:08d}" for i in range(size)]
+        self.jamf_ids = {serial_number: i + 1 for i, serial_number in enumerate(self.serial_numbers)}
+        self.serial_numbers_by_jamf_id = {v: k for k, v in self.jamf_ids.items()}
+        self.dep_profile_uuids = {serial_number: profile_uuid for serial_number in self.serial_numbers}
+        self.mdm_capable = {serial_number: True for serial_number in self.serial_numbers}
+        self.last_contact_times = {serial_number: "2024-01-01T00:00:00.000Z" for serial_number in self.serial_numbers}
+        self.tags = {serial_number: [ready_tag] for serial_number in self.serial_numbers}
+        self.lock = threading.Lock()
+
+
+class FakeBackendHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    backend = None
+    routes = ()
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status_code, body=None, headers=None):
+        content = b"" if body is None else json.dumps(body).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def dispatch(self, method):
+        server = self.server
+        url = urllib.parse.urlsplit(self.path)
+        body = self.read_body()
+        for route_method, pattern, endpoint, view in self.routes:
+            if route_method != method:
+                continue
+            m = re.fullmatch(pattern, url.path)
+            if m:
+                break
+        else:
+            server.count(method, "unknown")
+            return self.send_json(404)
+        server.count(method, endpoint)
+        if server.latency:
+            time.sleep(random.expovariate(1 / server.latency))
+        if endpoint != "token":
+            injected = server.inject_error()
+            if injected:
+                return self.send_json(*injected)
+        return view(self, m, dict(urllib.parse.parse_qsl(url.query)), body)
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_HEAD(self):
+        self.server.count("HEAD", "root")
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler_class, fleet, latency=0, error_rate=0, throttle_rate=0, unauthorized_rate=0):
+        super().__init__(("127.0.0.1", 0), handler_class)
+        self.fleet = fleet
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.unauthorized_rate = unauthorized_rate
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def count(self, method, endpoint):
+        with self._lock:
+            self.counts[f"{method} {endpoint}"] += 1
+
+    def inject_error(self):
+        r = random.random()
+        if r < self.error_rate:
+            return 500, {"error": "injected"}
+        r -= self.error_rate
+        if r < self.throttle_rate:
+            return 429, None, {"Retry-After": "1"}
+        r -= self.throttle_rate
+        if r < self.unauthorized_rate:
+            return 401, None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+# Jamf
+
+
+def jamf_token(handler, m, params, body):
+    handler.send_json(200, {"access_token": "fake-jamf-token", "token_type": "Bearer", "expires_in": 1200})
+
+
+def jamf_computer(handler, m, params, body):
+    fleet = handler.server.fleet
+    serial_number = m.group("serial_number")
+    if serial_number not in fleet.jamf_ids:
+        return handler.send_json(404)
+    general = {
+        "id": fleet.jamf_ids[serial_number],
+        "serial_number": serial_number,
+        "mdm_capable": fleet.mdm_capable[serial_number],
+    }
+    computer = {"general": general}
+    if not m.group("subsets"):
+        # full record ballast
+        computer["software"] = {"applications": [{"name": f"App {i}.app", "version": "1.0"} for i in range(300)]}
+    handler.send_json(200, {"computer": computer})
+
+
+def jamf_computers_basic(handler, m, params, body):
+    fleet = handler.server.fleet
+    handler.send_json(200, {"computers": [
+        {"id": jamf_id, "name": serial_number, "managed": fleet.mdm_capable[serial_number],
+         "serial_number": serial_number}
+        for serial_number, jamf_id in fleet.jamf_ids.items()
+    ]})
+
+
+def jamf_unmanage(handler, m, params, body):
+    fleet = handler.server.fleet
+    with fleet.lock:
+        for jamf_id in m.group("ids").split(","):
+            serial_number = fleet.serial_numbers_by_jamf_id.get(int(jamf_id))
+            if serial_number is None:
+                return handler.send_json(404)
+            fleet.mdm_capable[serial_number] = False
+    handler.send_json(201)
+
+
+def jamf_computers_inventory(handler, m, params, body):
+    # only the hardware.serialNumber=in=(…) and general.lastContactTime=ge=… filters
+    fleet = handler.server.fleet
+    serial_numbers = fleet.serial_numbers
+    rsql_filter = params.get("filter", "")
+    m = re.fullmatch(r"hardware\.serialNumber=in=\((.*)\)", rsql_filter)
+    if m:
+        serial_numbers = [sn.strip('"') for sn in m.group(1).split(",") if sn.strip('"') in fleet.jamf_ids]
+    m = re.fullmatch(r'general\.lastContactTime=ge="?([^"]+)"?', rsql_filter)
+    if m:
+        serial_numbers = [sn for sn in serial_numbers if fleet.last_contact_times[sn] >= m.group(1)]
+    page = int(params.get("page", 0))
+    page_size = int(params.get("page-size", 100))
+    handler.send_json(200, {
+        "totalCount": len(serial_numbers),
+        "results": [
+            {"id": str(fleet.jamf_ids[sn]),
+             "general": {"lastContactTime": fleet.last_contact_times[sn],
+                         "mdmCapable": {"capable": fleet.mdm_capable[sn], "capableUsers": []}},
+             "hardware": {"serialNumber": sn}}
+            for sn in serial_numbers[page * page_size:(page + 1) * page_size]
+        ]
+    })
+
+
+class FakeJamfHandler(FakeBackendHandler):
+    backend = "jamf"
+    routes = (
+        ("POST", r"/api/oauth/token", "token", jamf_token),
+        ("GET", r"/JSSResource/computers/serialnumber/(?P<serial_number>[^/]+)(?:/subset/(?P<subsets>.+))?",
+         "computer", jamf_computer),
+        ("GET", r"/JSSResource/computers/subset/basic", "computers_basic", jamf_computers_basic),
+        ("GET", r"/api/v1/computers-inventory", "computers_inventory", jamf_computers_inventory),
+        ("POST", r"/JSSResource/computercommands/command/UnmanageDevice/id/(?P<ids>[0-9,]+)",
+         "unmanage", jamf_unmanage),
+    )
+
+
+# Zentral
+
+
+def paginate(handler, items, params):
+    limit = int(params.get("limit", 100))
+    offset = int(params.get("offset", 0))
+    next_url = None
+    if offset + limit < len(items):
+        query = dict(params, limit=limit, offset=offset + limit)
+        next_url = f"{handler.server.base_url}{handler.path.split('?')[0]}?{urllib.parse.urlencode(query)}"
+    handler.send_json(200, {"count": len(items), "next": next_url, "results": items[offset:offset + limit]})
+
+
+def zentral_dep_devices(handler, m, params, body):
+    fleet = handler.server.fleet
+    serial_number = params.get("serial_number")
+    serial_numbers = [serial_number] if serial_number in fleet.jamf_ids else []
+    if not serial_number:
+        serial_numbers = fleet.serial_numbers
+    profile_uuid = params.get("profile_uuid")
+    items = [{"serial_number": sn, "profile_uuid": fleet.dep_profile_uuids[sn], "profile_status": "pushed"}
+             for sn in serial_numbers
+             if not profile_uuid or fleet.dep_profile_uuids[sn] == profile_uuid]
+    paginate(handler, items, params)
+
+
+def zentral_mdm_devices(handler, m, params, body):
+    fleet = handler.server.fleet
+    serial_number = params.get("serial_number")
+    serial_numbers = [serial_number] if serial_number in fleet.jamf_ids else []
+    if not serial_number:
+        serial_numbers = fleet.serial_numbers
+    updated_since = params.get("updated_since")
+    if updated_since:
+        # the fake enrollments are never updated
+        serial_numbers = []
+    items = [{"serial_number": sn,
+              "created_at": "2024-01-01T00:00:00",
+              "updated_at": "2024-01-01T00:00:00",
+              "cert_not_valid_after": "2099-01-01T00:00:00",
+              "blocked_at": None,
+              "checkout_at": None}
+             for sn in serial_numbers]
+    paginate(handler, items, params)
+
+
+def zentral_machine_meta(handler, m, params, body):
+    fleet = handler.server.fleet
+    serial_number = m.group("serial_number")
+    if serial_number not in fleet.tags:
+        return handler.send_json(404)
+    with fleet.lock:
+        tags = [{"taxonomy": {"name": fleet.taxonomy}, "name": t} for t in fleet.tags[serial_number]]
+    handler.send_json(200, {"serial_number": serial_number, "tags": tags})
+
+
+def zentral_machines(handler, m, params, body):
+    fleet = handler.server.fleet
+    tag = params.get("tag")
+    with fleet.lock:
+        items = [{"serial_number": sn, "tags": [{"taxonomy": {"name": fleet.taxonomy}, "name": t} for t in tags]}
+                 for sn, tags in fleet.tags.items() if tag is None or tag in tags]
+    paginate(handler, items, params)
+
+
+def zentral_machine_tags(handler, m, params, body):
+    fleet = handler.server.fleet
+    data = json.loads(body)
+    with fleet.lock:
+        for serial_number in data["serial_numbers"]:
+            for operation in data["operations"]:
+                fleet.tags[serial_number] = list(operation["names"])
+    handler.send_json(201, {"machines": {"found": len(data["serial_numbers"])}})
+
+
+class FakeZentralHandler(FakeBackendHandler):
+    backend = "zentral"
+    routes = (
+        ("GET", r"/api/mdm/dep/devices/", "dep_devices", zentral_dep_devices),
+        ("GET", r"/api/mdm/devices/", "mdm_devices", zentral_mdm_devices),
+        ("GET", r"/api/inventory/machines/", "machines", zentral_machines),
+        ("GET", r"/api/inventory/machines/(?P<serial_number>[^/]+)/meta/", "machine_meta", zentral_machine_meta),
+        ("POST", r"/api/inventory/machines/tags/", "machine_tags", zentral_machine_tags),
+    )
+
+
+# AWS parameters and secrets lambda extension
+
+
+class FakeSecretsHandler(FakeBackendHandler):
+    backend = "secrets"
+
+    def do_GET(self):
+        self.server.count("GET", "secret")
+        self.send_json(200, {"SecretString": json.dumps(self.server.secrets)})
+
+
+class FakeSecretsServer(FakeServer):
+    def __init__(self, secrets):
+        super().__init__(FakeSecretsHandler, None)
+        self.secrets = secrets
@@ -0,0 +1,204 @@
+"""Offline benchmark of the lambda handler and the migration manager,
+against local stand-ins for the Jamf and Zentral APIs.
+
+python benchmarks/run.py --mode handler --devices 500 --concurrency 20 --latency-ms 30
+"""
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import importlib.util
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeFleet, FakeJamfHandler, FakeSecretsServer, FakeServer, FakeZentralHandler  # NOQA
+from nekobus.metrics import InMemoryMetricsSink, collect_metrics  # NOQA
+from nekobus.migration import MigrationManager  # NOQA
+
+
+PROFILE_UUID = "5a1c9a25-0b36-4f34-a3a7-b2a0a1b4c0de"
+TAXONOMY = "Migration"
+TAGS = ("ready", "started", "unenrolled", "finished")
+NEKOBUS_TOKEN = "benchmark-nekobus-token"
+WAVE = (("check", "GET"), ("start", "POST"), ("status", "GET"), ("finish", "POST"))
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def load_lambda_function():
+    spec = importlib.util.spec_from_file_location("lambda_function", os.path.join(ROOT, "lambda", "lambda_function.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.fleet = FakeFleet(args.fleet_size, PROFILE_UUID, TAXONOMY, TAGS[0])
+        server_kwargs = {
+            "latency": args.latency_ms / 1000,
+            "error_rate": args.error_rate,
+            "throttle_rate": args.throttle_rate,
+        }
+        self.jamf = FakeServer(FakeJamfHandler, self.fleet, unauthorized_rate=args.unauthorized_rate,
+                               **server_kwargs).start()
+        self.zentral = FakeServer(FakeZentralHandler, self.fleet, **server_kwargs).start()
+        self.secrets = FakeSecretsServer({
+            "nekobus_token": NEKOBUS_TOKEN,
+            "jamf_client_secret": "benchmark-jamf-secret",
+            "zentral_token": "benchmark-zentral-token",
+        }).start()
+        self.serial_numbers = self.fleet.serial_numbers[:args.devices]
+        self.metrics_sink = InMemoryMetricsSink()
+
+    def stop(self):
+        for server in (self.jamf, self.zentral, self.secrets):
+            server.stop()
+
+    def environ(self):
+        return {
+            "NEKOBUS_SECRET_NAME": "nekobus",
+            "AWS_SESSION_TOKEN": "benchmark",
+            "PARAMETERS_SECRETS_EXTENSION_HTTP_PORT": str(self.secrets.server_port),
+            "NEKOBUS_JAMF_BASE_URL": self.jamf.base_url,
+            "NEKOBUS_JAMF_CLIENT_ID": "benchmark",
+            "NEKOBUS_ZENTRAL_BASE_URL": self.zentral.base_url,
+            "NEKOBUS_PROFILE_UUID": PROFILE_UUID,
+            "NEKOBUS_TAXONOMY": TAXONOMY,
+            "NEKOBUS_READY_TAG": TAGS[0],
+            "NEKOBUS_STARTED_TAG": TAGS[1],
+            "NEKOBUS_UNENROLLED_TAG": TAGS[2],
+            "NEKOBUS_FINISHED_TAG": TAGS[3],
+            "NEKOBUS_MAX_WORKERS": str(self.args.concurrency),
+            "NEKOBUS_JAMF_MAX_RATE": str(self.args.max_rate),
+            "NEKOBUS_ZENTRAL_MAX_RATE": str(self.args.max_rate),
+        }
+
+    def request_counts(self):
+        counts = Counter()
+        for name, server in (("jamf", self.jamf), ("zentral", self.zentral), ("secrets", self.secrets)):
+            for endpoint, count in server.counts.items():
+                counts[f"{name} {endpoint}"] = count
+        return counts
+
+    # drivers
+
+    def run_handler_wave(self, handler, op, method):
+        def invoke(serial_number):
+            event = {
+                "headers": {"authorization": f"Bearer {NEKOBUS_TOKEN}"},
+                "queryStringParameters": {"operation": op, "serial_number": serial_number},
+                "requestContext": {"http": {"method": method}},
+            }
+            start = time.perf_counter()
+            response = handler(event, None)
+            return time.perf_counter() - start, response["statusCode"]
+
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            return list(executor.map(invoke, self.serial_numbers))
+
+    def run_manager_wave(self, mm, op, method):
+        def invoke(serial_numbers):
+            # the lambda handler collects and emits the metrics of each operation
+            with collect_metrics() as collector:
+                start = time.perf_counter()
+                results = getattr(mm, f"{op}_many")(serial_numbers)
+                duration = time.perf_counter() - start
+            self.metrics_sink.emit(collector)
+            return [(duration, r.get("status_code", 200)) for r in results]
+
+        samples = []
+        for i in range(0, len(self.serial_numbers), self.args.batch_size):
+            samples.extend(invoke(self.serial_numbers[i:i + self.args.batch_size]))
+        return samples
+
+    def run(self):
+        os.environ.update(self.environ())
+        if self.args.mode == "handler":
+            lambda_function = load_lambda_function()
+            # the lambda function sets the root logger level
+            logging.getLogger().setLevel(logging.INFO if self.args.verbose else logging.CRITICAL)
+            handler = lambda_function.LamdbaHandler(self.metrics_sink)
+            # cold start
+            handler.initialize()
+            target, run_wave = handler, self.run_handler_wave
+        else:
+            target = MigrationManager(
+                self.jamf.base_url, "benchmark", "benchmark-jamf-secret",
+                self.zentral.base_url, "benchmark-zentral-token",
+                PROFILE_UUID, TAXONOMY, *TAGS,
+                max_workers=self.args.concurrency,
+                jamf_max_rate=self.args.max_rate,
+                zentral_max_rate=self.args.max_rate,
+            )
+            run_wave = self.run_manager_wave
+        report = {"mode": self.args.mode, "devices": len(self.serial_numbers), "waves": []}
+        for op, method in WAVE:
+            counts_before = self.request_counts()
+            start = time.perf_counter()
+            samples = run_wave(target, op, method)
+            duration = time.perf_counter() - start
+            latencies = [s[0] * 1000 for s in samples]
+            report["waves"].append({
+                "operation": op,
+                "duration_s": round(duration, 3),
+                "throughput_per_s": round(len(samples) / duration, 1),
+                "latency_ms": {
+                    "mean": round(statistics.mean(latencies), 1),
+                    "p50": round(percentile(latencies, 50), 1),
+                    "p90": round(percentile(latencies, 90), 1),
+                    "p99": round(percentile(latencies, 99), 1),
+                },
+                "status_codes": dict(Counter(str(s[1]) for s in samples)),
+                "requests": dict(self.request_counts() - counts_before),
+            })
+        backend_calls = {}
+        for call in self.metrics_sink.calls:
+            backend_calls.setdefault(f"{call['backend']} {call['endpoint']}", []).append(call["duration"] * 1000)
+        report["backend_latency_ms"] = {
+            key: {"count": len(v), "p50": round(percentile(v, 50), 1), "p99": round(percentile(v, 99), 1)}
+            for key, v in sorted(backend_calls.items())
+        }
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("handler", "manager"), default="handler",
+                        help="drive the lambda handler device by device, or the batch operations")
+    parser.add_argument("--fleet-size", type=int, default=2000)
+    parser.add_argument("--devices", type=int, default=200, help="number of devices in the wave")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--max-rate", type=float, default=50, help="max requests per second per backend")
+    parser.add_argument("--batch-size", type=int, default=100, help="devices per batch in manager mode")
+    parser.add_argument("--latency-ms", type=float, default=20, help="mean backend latency")
+    parser.add_argument("--error-rate", type=float, default=0, help="rate of injected 500 responses")
+    parser.add_argument("--throttle-rate", type=float, default=0, help="rate of injected 429 responses")
+    parser.add_argument("--unauthorized-rate", type=float, default=0, help="rate of injected Jamf 401 responses")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    benchmark = Benchmark(args)
+    try:
+        report = benchmark.run()
+    finally:
+        benchmark.stop()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
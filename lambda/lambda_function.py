@@ -1,9 +1,14 @@
+import time
+IMPORT_START = time.perf_counter()
+import base64
 import hmac
 import json
 import logging
 import os
 import requests
+from nekobus.metrics import EMFMetricsSink, collect_metrics
 from nekobus.migration import MigrationError, MigrationManager
+IMPORT_DURATION = time.perf_counter() - IMPORT_START
 
 
 logger = logging.getLogger()
@@ -24,6 +29,19 @@ logger.setLevel(logging.INFO)
 # NEKOBUS_STARTED_TAG
 # NEKOBUS_UNENROLLED_TAG
 # NEKOBUS_FINISHED_TAG
+# NEKOBUS_MAX_WORKERS (optional)
+# NEKOBUS_MAX_CONNECTIONS (optional, max in-flight requests per backend, default NEKOBUS_MAX_WORKERS)
+# NEKOBUS_JAMF_MAX_RATE (optional, max Jamf requests per second, default 50)
+# NEKOBUS_ZENTRAL_MAX_RATE (optional, max Zentral requests per second, default 50)
+# NEKOBUS_IMPORT_BUDGET_MS (optional, default 500)
+# NEKOBUS_DEP_DEVICE_INDEX_TTL (optional, in seconds. If set, the DEP devices are synced in bulk)
+# NEKOBUS_MDM_ENROLLED_DEVICE_INDEX_TTL (optional, in seconds. If set, the MDM enrolled devices are synced in bulk)
+# NEKOBUS_JAMF_COMPUTER_INDEX_TTL (optional, in seconds. If set, the Jamf computers are synced in bulk)
+# NEKOBUS_JAMF_COMPUTER_INDEX_TRACKED_ONLY (optional, if set to 1, only the started and polled devices are synced)
+# NEKOBUS_JAMF_TOKEN_CACHE_PATH (optional, file to share the Jamf access token)
+# NEKOBUS_STATUS_TIMEOUT (optional, in seconds. If set, status returns partial results after this time)
+# NEKOBUS_JAMF_WEBHOOKS (optional, if set to 1, Jamf is not called by status for the devices tagged as unenrolled)
+# NEKOBUS_METRICS_NAMESPACE (optional, CloudWatch metrics namespace, default Nekobus)
 
 
 def build_response(status_code, err=None, body=None, headers=None):
@@ -42,6 +60,14 @@ def build_response(status_code, err=None, body=None, headers=None):
     return response
 
 
+def get_migration_error_message(migration_error):
+    if migration_error.status_code == 404:
+        return "Not found"
+    if migration_error.status_code >= 500:
+        return "Internal server error"
+    return "Bad request"
+
+
 class LambdaError(Exception):
     def __init__(self, message, status_code, body=None, headers=None):
         super().__init__(message)
@@ -63,24 +89,42 @@ class LamdbaHandler:
         "finish": "POST",
     }
 
+    batch_operations = {
+        "check_many": "POST",
+        "start_many": "POST",
+        "status_many": "POST",
+        "finish_many": "POST",
+    }
+    max_batch_size = 500
+    start_jobs_timeout = 60  # 1 min, max duration of a run_start_jobs call
+
+    webhook_operations = {
+        "jamf_webhook": "POST",
+    }
+
     expected_secrets = (
         "nekobus_token",
         "jamf_client_secret",
         "zentral_token",
     )
 
+    def fetch_secrets(self):
+        r = requests.get(
+            "http://localhost:{}/secretsmanager/get".format(
+                os.environ.get("PARAMETERS_SECRETS_EXTENSION_HTTP_PORT", "2773")
+            ),
+            params={"secretId": os.environ["NEKOBUS_SECRET_NAME"]},
+            headers={
+                "X-Aws-Parameters-Secrets-Token": os.environ["AWS_SESSION_TOKEN"]
+            },
+        )
+        r.raise_for_status()
+        return json.loads(r.json()["SecretString"])
+
     def get_secrets(self):
         logger.info("Get secrets")
         try:
-            r = requests.get(
-                "http://localhost:2773/secretsmanager/get",
-                params={"secretId": os.environ["NEKOBUS_SECRET_NAME"]},
-                headers={
-                    "X-Aws-Parameters-Secrets-Token": os.environ["AWS_SESSION_TOKEN"]
-                },
-            )
-            r.raise_for_status()
-            secrets = json.loads(r.json()["SecretString"])
+            secrets = self.fetch_secrets()
             assert isinstance(secrets, dict), "Invalid secret"
             assert set(secrets.keys()) == set(
                 self.expected_secrets
@@ -94,10 +138,18 @@ class LamdbaHandler:
         else:
             return (secrets[k] for k in self.expected_secrets)
 
-    def __init__(self):
+    # no background token refresh in the lambda, the instances are frozen between the requests
+    jamf_background_token_refresh = False
+
+    def __init__(self, metrics_sink=None):
         self._initialized = False
+        if metrics_sink is None:
+            metrics_sink = EMFMetricsSink(os.environ.get("NEKOBUS_METRICS_NAMESPACE", "Nekobus"))
+        self.metrics_sink = metrics_sink
         self.nekobus_token_bytes = None
         self.mm = None
+        # queued starts, only with the self-hosted server. The lambda instances don't share a file system.
+        self.job_store = None
 
     def initialize(self):
         if not self._initialized:
@@ -115,6 +167,43 @@ class LamdbaHandler:
                 os.environ["NEKOBUS_STARTED_TAG"],
                 os.environ["NEKOBUS_UNENROLLED_TAG"],
                 os.environ["NEKOBUS_FINISHED_TAG"],
+                max_workers=int(os.environ.get("NEKOBUS_MAX_WORKERS", 0)),
+                dep_device_index_ttl=int(os.environ.get("NEKOBUS_DEP_DEVICE_INDEX_TTL", 0)),
+                mdm_enrolled_device_index_ttl=int(os.environ.get("NEKOBUS_MDM_ENROLLED_DEVICE_INDEX_TTL", 0)),
+                jamf_token_cache_path=os.environ.get("NEKOBUS_JAMF_TOKEN_CACHE_PATH"),
+                jamf_background_token_refresh=self.jamf_background_token_refresh,
+                status_timeout=float(os.environ.get("NEKOBUS_STATUS_TIMEOUT", 0)),
+                max_connections=int(os.environ.get("NEKOBUS_MAX_CONNECTIONS", 0)),
+                jamf_max_rate=float(os.environ.get("NEKOBUS_JAMF_MAX_RATE", 0)),
+                zentral_max_rate=float(os.environ.get("NEKOBUS_ZENTRAL_MAX_RATE", 0)),
+                jamf_computer_index_ttl=int(os.environ.get("NEKOBUS_JAMF_COMPUTER_INDEX_TTL", 0)),
+                jamf_computer_index_tracked_only=os.environ.get("NEKOBUS_JAMF_COMPUTER_INDEX_TRACKED_ONLY") == "1",
+                jamf_webhooks=os.environ.get("NEKOBUS_JAMF_WEBHOOKS") == "1",
+            )
+            self._initialized = True
+
+    def warm_up(self):
+        # called during the lambda init phase.
+        # Errors are only logged, the initialization is attempted again with the first request.
+        import_duration_ms = IMPORT_DURATION * 1000
+        import_budget_ms = int(os.environ.get("NEKOBUS_IMPORT_BUDGET_MS", 500))
+        if import_duration_ms > import_budget_ms:
+            logger.warning("Imports: %.0fms > %dms budget", import_duration_ms, import_budget_ms)
+        else:
+            logger.info("Imports: %.0fms", import_duration_ms)
+        try:
+            start = time.perf_counter()
+            self.initialize()
+            secrets_end = time.perf_counter()
+            self.mm.warm_up()
+            warm_up_end = time.perf_counter()
+        except Exception:
+            logger.exception("Could not warm up")
+        else:
+            logger.info(
+                "Initialization: %.0fms, warm up: %.0fms",
+                (secrets_end - start) * 1000,
+                (warm_up_end - secrets_end) * 1000,
             )
 
     def authenticate(self, event):
@@ -127,15 +216,41 @@ class LamdbaHandler:
             if not hmac.compare_digest(request_token, self.nekobus_token_bytes):
                 raise LambdaError("Unauthorized", 401)
 
+    @staticmethod
+    def verify_serial_number(serial_number):
+        assert (
+            isinstance(serial_number, str) and len(serial_number) > 2
+        ), "Invalid serial number"
+
+    @staticmethod
+    def get_json_body(event):
+        body = event.get("body") or ""
+        if event.get("isBase64Encoded"):
+            body = base64.b64decode(body)
+        return json.loads(body)
+
+    def get_serial_numbers(self, event):
+        serial_numbers = self.get_json_body(event)["serial_numbers"]
+        assert isinstance(serial_numbers, list), "Invalid serial numbers"
+        assert 0 < len(serial_numbers) <= self.max_batch_size, "Invalid number of serial numbers"
+        for serial_number in serial_numbers:
+            self.verify_serial_number(serial_number)
+        return serial_numbers
+
     def process_params(self, event):
         try:
             params = event["queryStringParameters"]
             op = params["operation"]
-            allowed_http_method = self.allowed_operations[op]
-            serial_number = params["serial_number"]
-            assert (
-                isinstance(serial_number, str) and len(serial_number) > 2
-            ), "Invalid serial number"
+            if op in self.batch_operations:
+                allowed_http_method = self.batch_operations[op]
+                serial_number = self.get_serial_numbers(event)
+            elif op in self.webhook_operations:
+                allowed_http_method = self.webhook_operations[op]
+                serial_number = None
+            else:
+                allowed_http_method = self.allowed_operations[op]
+                serial_number = params["serial_number"]
+                self.verify_serial_number(serial_number)
         except Exception:
             err = "Bad request"
             logger.exception(err)
@@ -146,6 +261,65 @@ class LamdbaHandler:
             )
         return op, serial_number
 
+    def execute_batch_operation(self, op, serial_numbers):
+        logger.info("Operation %s %d device(s)", op, len(serial_numbers))
+        try:
+            results = getattr(self.mm, op)(serial_numbers)
+        except Exception:
+            logger.exception("Operation %s error", op)
+            raise LambdaError("Internal server error", 500, body={"operation": op})
+        logger.info("Operation %s %d device(s) OK", op, len(serial_numbers))
+        return build_response(200, body={"operation": op, "results": results})
+
+    def get_idempotency_key(self, event, op):
+        if op != "start" or self.job_store is None:
+            return
+        idempotency_key = event["headers"].get("idempotency-key")
+        if idempotency_key is not None and not (0 < len(idempotency_key) <= 255):
+            raise LambdaError("Bad request", 400)
+        return idempotency_key
+
+    def queue_start(self, serial_number, idempotency_key):
+        logger.info("Operation start device %s queued", serial_number)
+        body = {
+            "operation": "start",
+            "serial_number": serial_number,
+        }
+        try:
+            job = self.mm.queue_start(serial_number, idempotency_key, self.job_store)
+        except MigrationError as e:
+            logger.error("Operation start device %s error: %s", serial_number, e)
+            raise LambdaError(get_migration_error_message(e), e.status_code, body=body)
+        except Exception:
+            logger.exception("Operation start device %s error", serial_number)
+            raise LambdaError("Internal server error", 500, body=body)
+        body["job"] = job.serialize()
+        return build_response(202, body=body)
+
+    def run_start_jobs(self):
+        self.initialize()
+        if self.job_store is None:
+            logger.error("No job store")
+            return {"job_count": 0}
+        return {"job_count": self.mm.run_start_jobs(self.job_store, timeout=self.start_jobs_timeout)}
+
+    def process_jamf_webhook(self, event):
+        try:
+            payload = self.get_json_body(event)
+            assert isinstance(payload["webhook"]["webhookEvent"], str), "Invalid webhook event"
+        except Exception:
+            err = "Bad request"
+            logger.exception(err)
+            raise LambdaError(err, 400)
+        try:
+            result = self.mm.process_jamf_webhook(payload)
+        except Exception:
+            logger.exception("Operation jamf_webhook error")
+            raise LambdaError("Internal server error", 500, body={"operation": "jamf_webhook"})
+        body = {"operation": "jamf_webhook"}
+        body.update(result)
+        return build_response(200, body=body)
+
     def execute_operation(self, op, serial_number):
         logger.info("Operation %s device %s", op, serial_number)
         body = {
@@ -156,7 +330,7 @@ class LamdbaHandler:
             result = getattr(self.mm, op)(serial_number)
         except MigrationError as e:
             logger.error("Operation %s device %s error: %s", op, serial_number, e)
-            raise LambdaError("Not found" if e.status_code == 404 else "Bad request", e.status_code, body=body)
+            raise LambdaError(get_migration_error_message(e), e.status_code, body=body)
         except Exception:
             logger.exception("Operation %s device %s error", op, serial_number)
             raise LambdaError("Internal server error", 500, body=body)
@@ -170,14 +344,32 @@ class LamdbaHandler:
         self.initialize()
         self.authenticate(event)
         op, serial_number = self.process_params(event)
+        if op in self.batch_operations:
+            return self.execute_batch_operation(op, serial_number)
+        if op == "jamf_webhook":
+            return self.process_jamf_webhook(event)
+        idempotency_key = self.get_idempotency_key(event, op)
+        if idempotency_key:
+            return self.queue_start(serial_number, idempotency_key)
         return self.execute_operation(op, serial_number)
 
     def __call__(self, event, context):
         logger.info("New request")
-        try:
-            return self.process_event(event)
-        except LambdaError as e:
-            return e.build_response()
+        with collect_metrics() as collector:
+            try:
+                return self.process_event(event)
+            except LambdaError as e:
+                return e.build_response()
+            finally:
+                self.metrics_sink.emit(collector)
+                if self.mm:
+                    self.metrics_sink.emit_throttling(self.mm.throttling_metrics())
+                    logger.info("Cache stats: %s", json.dumps(self.mm.cache_stats()))
+                    logger.info("Throttling: %s", json.dumps(self.mm.throttling_metrics()))
+                    logger.info("Connection pools: %s", json.dumps(self.mm.connection_pool_metrics()))
 
 
 lambda_handler = LamdbaHandler()
+if "AWS_LAMBDA_FUNCTION_NAME" in os.environ:
+    lambda_handler.warm_up()
+
@@ -0,0 +1,181 @@
+# Self-hosted HTTP server for the lambda function operations.
+# The HTTP requests are converted to Lambda function URL events, and processed concurrently
+# by a single handler, sharing the MigrationManager, its connection pools, Jamf token and caches.
+#
+# Same environment variables as the lambda function, except NEKOBUS_SECRET_NAME. The secrets are read from:
+# NEKOBUS_SECRETS_PATH (optional, JSON file with the same keys as the AWS secret)
+# or NEKOBUS_TOKEN, NEKOBUS_JAMF_CLIENT_SECRET and NEKOBUS_ZENTRAL_TOKEN
+# NEKOBUS_SERVER_ADDRESS (optional, default 127.0.0.1)
+# NEKOBUS_SERVER_PORT (optional, default 8080)
+# NEKOBUS_JOB_STORE_PATH (optional, SQLite database path. If set, start is queued with an Idempotency-Key)
+# NEKOBUS_JOB_WORKER_INTERVAL (optional, in seconds, default 10. The queued start jobs are drained in the background)
+import base64
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import urllib.parse
+from lambda_function import LambdaError, LamdbaHandler
+from nekobus.jobs import SQLiteJobStore
+
+
+logger = logging.getLogger("nekobus.server")
+
+
+class ServerHandler(LamdbaHandler):
+    # the Jamf access token is refreshed before it expires, not during a request
+    jamf_background_token_refresh = True
+    secret_environment_variables = {
+        "nekobus_token": "NEKOBUS_TOKEN",
+        "jamf_client_secret": "NEKOBUS_JAMF_CLIENT_SECRET",
+        "zentral_token": "NEKOBUS_ZENTRAL_TOKEN",
+    }
+
+    def initialize(self):
+        if not self._initialized:
+            super().initialize()
+            job_store_path = os.environ.get("NEKOBUS_JOB_STORE_PATH")
+            if job_store_path:
+                self.job_store = SQLiteJobStore(job_store_path)
+
+    def fetch_secrets(self):
+        secrets_path = os.environ.get("NEKOBUS_SECRETS_PATH")
+        if secrets_path:
+            with open(secrets_path) as f:
+                return json.load(f)
+        return {k: os.environ[v] for k, v in self.secret_environment_variables.items()}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "nekobus"
+    max_body_size = 10 * 2**20  # 10 MiB
+
+    def log_message(self, format, *args):
+        logger.info("%s %s", self.address_string(), format % args)
+
+    def read_chunked_body(self):
+        body = bytearray()
+        while True:
+            try:
+                # chunk extensions are ignored
+                size = int(self.rfile.readline(1024).split(b";", 1)[0].strip(), 16)
+            except ValueError:
+                raise LambdaError("Bad request", 400)
+            if size == 0:
+                break
+            if len(body) + size > self.max_body_size:
+                raise LambdaError("Payload too large", 413)
+            body += self.rfile.read(size)
+            self.rfile.readline(1024)  # chunk CRLF
+        # trailer section
+        while self.rfile.readline(1024) not in (b"\r\n", b"\n", b""):
+            pass
+        return bytes(body)
+
+    def read_body(self, method):
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            return self.read_chunked_body()
+        length = self.headers.get("Content-Length")
+        if length is None:
+            if method == "POST":
+                # the end of the body could not be found on a keep-alive connection
+                raise LambdaError("Length required", 411)
+            return b""
+        try:
+            length = int(length)
+        except ValueError:
+            raise LambdaError("Bad request", 400)
+        if length > self.max_body_size:
+            raise LambdaError("Payload too large", 413)
+        return self.rfile.read(length) if length > 0 else b""
+
+    def build_event(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        body = self.read_body(method)
+        return {
+            "headers": {k.lower(): v for k, v in self.headers.items()},
+            "queryStringParameters": dict(urllib.parse.parse_qsl(url.query)),
+            "requestContext": {"http": {"method": method, "path": url.path}},
+            "body": base64.b64encode(body).decode("ascii") if body else None,
+            "isBase64Encoded": bool(body),
+        }
+
+    def handle_event(self, method):
+        try:
+            event = self.build_event(method)
+        except LambdaError as e:
+            # the unread body would be parsed as the next request
+            self.close_connection = True
+            response = e.build_response()
+        else:
+            response = self.server.handler(event, None)
+        content = response["body"].encode("utf-8")
+        self.send_response(response["statusCode"])
+        for k, v in response["headers"].items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(content)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.handle_event("GET")
+
+    def do_POST(self):
+        self.handle_event("POST")
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler):
+        super().__init__(server_address, RequestHandler)
+        self.handler = handler
+
+
+def run_start_jobs(handler, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            handler.run_start_jobs()
+        except Exception:
+            logger.exception("Could not run the start jobs")
+
+
+def main():
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s %(message)s")
+    handler = ServerHandler()
+    try:
+        # before serving, so that the requests don't race to initialize the handler
+        handler.initialize()
+    except Exception:
+        logger.exception("Could not initialize the handler")
+        sys.exit(1)
+    handler.mm.warm_up()
+    if handler.job_store:
+        threading.Thread(
+            target=run_start_jobs,
+            args=(handler, float(os.environ.get("NEKOBUS_JOB_WORKER_INTERVAL", 10))),
+            daemon=True,
+        ).start()
+    server = Server(
+        (os.environ.get("NEKOBUS_SERVER_ADDRESS", "127.0.0.1"), int(os.environ.get("NEKOBUS_SERVER_PORT", 8080))),
+        handler,
+    )
+    logger.info("Listening on %s:%s", *server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
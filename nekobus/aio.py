@@ -0,0 +1,88 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import functools
+import logging
+from .zentral import ZentralTagBatcher
+
+
+logger = logging.getLogger(__name__)
+
+
+# asyncio interface to a MigrationManager. The operations are delegated to the
+# MigrationManager methods, run in a thread pool, to keep their behaviour
+# (checks, tags, indexes, caches, retries and timeouts).
+
+
+async def run_in_executor(executor, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(executor, functools.partial(ctx.run, func, *args, **kwargs))
+
+
+class AsyncMigrationManager:
+    max_concurrency = 100  # max in-flight devices
+
+    def __init__(self, migration_manager, max_concurrency=None):
+        self.mm = migration_manager
+        if max_concurrency:
+            self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="nekobus-aio")
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    async def check(self, serial_number):
+        logger.info("Check device %s", serial_number)
+        # independent lookups, run concurrently
+        tags, dep_status = await asyncio.gather(
+            run_in_executor(self.executor, self.mm.zentral_client.get_tags, serial_number),
+            run_in_executor(self.executor, self.mm.zentral_client.get_dep_status, serial_number, self.mm.profile_uuid),
+        )
+        return self.mm.build_check_result(serial_number, tags, dep_status)
+
+    async def start(self, serial_number, tag_batcher=None):
+        return await run_in_executor(self.executor, self.mm.start, serial_number, tag_batcher)
+
+    async def status(self, serial_number, tag_batcher=None):
+        return await run_in_executor(self.executor, self.mm.status, serial_number, tag_batcher)
+
+    async def finish(self, serial_number, tag_batcher=None):
+        return await run_in_executor(self.executor, self.mm.finish, serial_number, tag_batcher)
+
+    # batch operations
+
+    async def _run_one(self, semaphore, op, serial_number, **kwargs):
+        async with semaphore:
+            return await run_in_executor(self.executor, self.mm._run_one, op, serial_number, **kwargs)
+
+    async def _run_many(self, op, serial_numbers, write_tags=False):
+        serial_numbers = list(dict.fromkeys(serial_numbers))
+        if not serial_numbers:
+            return []
+        logger.info("Operation %s on %d device(s)", op, len(serial_numbers))
+        kwargs = {}
+        if write_tags:
+            tag_batcher = kwargs["tag_batcher"] = ZentralTagBatcher(self.mm.zentral_client)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        results = await asyncio.gather(*(
+            self._run_one(semaphore, op, serial_number, **kwargs)
+            for serial_number in serial_numbers
+        ))
+        if write_tags:
+            await run_in_executor(self.executor, tag_batcher.flush)
+            self.mm.set_failed_tag_writes_errors(results, tag_batcher)
+        return results
+
+    async def check_many(self, serial_numbers):
+        return await self._run_many("check", serial_numbers)
+
+    async def start_many(self, serial_numbers):
+        # bulk Jamf UnmanageDevice commands
+        return await run_in_executor(self.executor, self.mm.start_many, serial_numbers)
+
+    async def status_many(self, serial_numbers):
+        return await self._run_many("status", serial_numbers, write_tags=True)
+
+    async def finish_many(self, serial_numbers):
+        return await self._run_many("finish", serial_numbers, write_tags=True)
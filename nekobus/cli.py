@@ -0,0 +1,240 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import json
+import logging
+import os
+import sys
+import time
+from .migration import MigrationManager
+from .report import MigrationReport
+from .throttling import TokenBucket
+from .zentral import ZentralTagBatcher
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_migration_manager(with_jamf=True, **kwargs):
+    for backend in ("jamf", "zentral"):
+        if not kwargs.get(f"{backend}_max_rate"):
+            kwargs[f"{backend}_max_rate"] = float(os.environ.get(f"NEKOBUS_{backend.upper()}_MAX_RATE", 0))
+    if with_jamf:
+        jamf_args = (
+            os.environ["NEKOBUS_JAMF_BASE_URL"],
+            os.environ["NEKOBUS_JAMF_CLIENT_ID"],
+            os.environ["NEKOBUS_JAMF_CLIENT_SECRET"],
+        )
+    else:
+        jamf_args = (None, None, None)
+    return MigrationManager(
+        *jamf_args,
+        os.environ["NEKOBUS_ZENTRAL_BASE_URL"],
+        os.environ["NEKOBUS_ZENTRAL_TOKEN"],
+        os.environ["NEKOBUS_PROFILE_UUID"],
+        os.environ["NEKOBUS_TAXONOMY"],
+        os.environ["NEKOBUS_READY_TAG"],
+        os.environ["NEKOBUS_STARTED_TAG"],
+        os.environ["NEKOBUS_UNENROLLED_TAG"],
+        os.environ["NEKOBUS_FINISHED_TAG"],
+        jamf_token_cache_path=os.environ.get("NEKOBUS_JAMF_TOKEN_CACHE_PATH"),
+        # long waves, the Jamf access token is refreshed before it expires
+        jamf_background_token_refresh=with_jamf,
+        **kwargs
+    )
+
+
+def iter_serial_numbers(stream):
+    for line in stream:
+        serial_number = line.strip()
+        if serial_number and not serial_number.startswith("#"):
+            yield serial_number
+
+
+class WaveRunner:
+    # Runs an operation on a list of devices, chunk by chunk, with a thread pool.
+    # The results are appended to the state file after each chunk. The devices with
+    # a result without error in the state file are skipped when the wave is resumed.
+    operations = ("check", "start", "status", "finish")
+    tag_operations = ("start", "status", "finish")
+    # operations run with the MigrationManager bulk methods, a chunk at a time
+    bulk_operations = {"start": "start_many"}
+    chunk_size = 200
+    progress_interval = 1  # 1 second
+
+    def __init__(self, mm, op, workers=None, rate=None, state_path=None, progress_stream=None):
+        if op not in self.operations:
+            raise ValueError(f"Unknown operation: {op}")
+        self.mm = mm
+        self.op = op
+        self.workers = workers or mm.max_workers
+        self.bucket = TokenBucket(rate) if rate else None
+        self.state_path = state_path
+        self.progress_stream = progress_stream
+        self.counts = {"done": 0, "skipped": 0, "errors": 0}
+        self._started_at = None
+        self._last_progress = None
+
+    def load_done_serial_numbers(self):
+        done = set()
+        if not self.state_path or not os.path.exists(self.state_path):
+            return done
+        with open(self.state_path) as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    # incomplete last line of an interrupted run
+                    logger.warning("Skip invalid state file line")
+                    continue
+                if result.get("operation") == self.op and "error" not in result:
+                    done.add(result["serial_number"])
+        return done
+
+    def run_one(self, serial_number, **kwargs):
+        if self.bucket:
+            self.bucket.acquire()
+        return self.mm._run_one(self.op, serial_number, **kwargs)
+
+    def run_bulk_chunk(self, serial_numbers):
+        if self.bucket:
+            for _ in serial_numbers:
+                self.bucket.acquire()
+        results = getattr(self.mm, self.bulk_operations[self.op])(serial_numbers)
+        self.counts["done"] += len(results)
+        self.print_progress()
+        return results
+
+    def run_threaded_chunk(self, executor, serial_numbers):
+        kwargs = {}
+        if self.op in self.tag_operations:
+            tag_batcher = kwargs["tag_batcher"] = ZentralTagBatcher(self.mm.zentral_client)
+        futures = [
+            executor.submit(contextvars.copy_context().run, self.run_one, serial_number, **kwargs)
+            for serial_number in serial_numbers
+        ]
+        results = []
+        for future in futures:
+            results.append(future.result())
+            self.counts["done"] += 1
+            self.print_progress()
+        if self.op in self.tag_operations:
+            tag_batcher.flush()
+            self.mm.set_failed_tag_writes_errors(results, tag_batcher)
+        return results
+
+    def run_chunk(self, executor, serial_numbers):
+        if self.op in self.bulk_operations:
+            results = self.run_bulk_chunk(serial_numbers)
+        else:
+            results = self.run_threaded_chunk(executor, serial_numbers)
+        for result in results:
+            result["operation"] = self.op
+            if "error" in result:
+                self.counts["errors"] += 1
+        return results
+
+    def save_results(self, results):
+        if not self.state_path:
+            return
+        with open(self.state_path, "a") as f:
+            for result in results:
+                f.write(json.dumps(result))
+                f.write("\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def print_progress(self, force=False):
+        if not self.progress_stream:
+            return
+        now = time.monotonic()
+        if not force and self._last_progress and now - self._last_progress < self.progress_interval:
+            return
+        self._last_progress = now
+        elapsed = now - self._started_at
+        throughput = self.counts["done"] / elapsed if elapsed else 0
+        print(
+            f"{self.op}: {self.counts['done']} done, {self.counts['skipped']} skipped, "
+            f"{self.counts['errors']} error(s), {throughput:.1f} devices/s",
+            file=self.progress_stream,
+            flush=True,
+        )
+
+    def run(self, serial_numbers, output_stream=None):
+        self._started_at = time.monotonic()
+        done = self.load_done_serial_numbers()
+        chunk = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for serial_number in dict.fromkeys(serial_numbers):
+                if serial_number in done:
+                    self.counts["skipped"] += 1
+                    continue
+                chunk.append(serial_number)
+                if len(chunk) < self.chunk_size:
+                    continue
+                self.process_chunk(executor, chunk, output_stream)
+                chunk = []
+            if chunk:
+                self.process_chunk(executor, chunk, output_stream)
+        self.print_progress(force=True)
+        return self.counts
+
+    def process_chunk(self, executor, serial_numbers, output_stream):
+        results = self.run_chunk(executor, serial_numbers)
+        self.save_results(results)
+        if output_stream:
+            for result in results:
+                output_stream.write(json.dumps(result))
+                output_stream.write("\n")
+            output_stream.flush()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="nekobus", description="Run Nekobus migration waves")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for op in WaveRunner.operations:
+        subparser = subparsers.add_parser(op, help=f"{op} the devices")
+        subparser.add_argument("input", nargs="?", default="-",
+                               help="file with one serial number per line, - for stdin (default)")
+        subparser.add_argument("--workers", type=int, default=MigrationManager.max_workers,
+                               help="number of devices processed concurrently")
+        subparser.add_argument("--rate", type=float,
+                               help="max number of devices processed per second")
+        subparser.add_argument("--state-file",
+                               help="file where the results are appended, used to resume the wave")
+        subparser.add_argument("--jamf-max-rate", type=float,
+                               help="max number of Jamf requests per second (default 50)")
+        subparser.add_argument("--zentral-max-rate", type=float,
+                               help="max number of Zentral requests per second (default 50)")
+    report_parser = subparsers.add_parser("report", help="report on the machines with a migration tag")
+    report_parser.add_argument("--format", choices=("csv", "ndjson"), default="ndjson")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    if args.command == "report":
+        mm = get_migration_manager(with_jamf=False)
+        counts = MigrationReport(mm).write(sys.stdout, args.format)
+        print(json.dumps(counts), file=sys.stderr)
+        return
+    mm = get_migration_manager(
+        max_workers=args.workers,
+        jamf_max_rate=args.jamf_max_rate,
+        zentral_max_rate=args.zentral_max_rate,
+    )
+    runner = WaveRunner(mm, args.command, args.workers, args.rate, args.state_file, sys.stderr)
+    if args.input == "-":
+        counts = runner.run(iter_serial_numbers(sys.stdin), sys.stdout)
+    else:
+        with open(args.input) as f:
+            counts = runner.run(iter_serial_numbers(f), sys.stdout)
+    logger.info("Connection pools: %s", json.dumps(mm.connection_pool_metrics()))
+    if counts["errors"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
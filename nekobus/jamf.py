@@ -1,8 +1,20 @@
-from datetime import datetime, timedelta
+from datetime import datetime
+import itertools
+import json
 import logging
+import os
+import tempfile
+import threading
+import time
 import requests
-from .utils import CustomHTTPAdapter
+from .metrics import timed_request
+from .throttling import BackendGovernor
+from .utils import CustomHTTPAdapter, TTLCache, decode_response, request_deadline
 from .version import __version__
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 logger = logging.getLogger(__name__)
 
@@ -11,12 +23,358 @@ class JamfClientError(Exception):
     pass
 
 
+class JamfTokenManager:
+    # Thread safe Jamf access token provider, with single-flight refresh.
+    # The token can be refreshed in a background thread before it expires,
+    # and shared with other processes using a cache file.
+    min_validity_seconds = 300  # 5 min
+    background_refresh_margin = 60  # background refresh 1 min before the min validity
+    background_min_sleep = 10  # 10 seconds, also after a background refresh error
+
+    def __init__(self, client, cache_path=None, background_refresh=False):
+        self.client = client
+        self.cache_path = cache_path
+        self.background_refresh = background_refresh
+        # protects the current token, never held during a refresh
+        self._lock = threading.Lock()
+        # single-flight refresh
+        self._refresh_lock = threading.Lock()
+        self._token = None
+        self._expires_at = None  # epoch, to be shared with the other processes
+        self._refresh_thread = None
+
+    def _is_valid(self, expires_at, min_validity_seconds=None):
+        if min_validity_seconds is None:
+            min_validity_seconds = self.min_validity_seconds
+        return expires_at is not None and expires_at - min_validity_seconds > time.time()
+
+    def _read_cache(self):
+        try:
+            with open(self.cache_path, "r") as f:
+                cached_token = json.load(f)
+            if cached_token["base_url"] == self.client.base_url and cached_token["client_id"] == self.client.client_id:
+                return cached_token["access_token"], cached_token["expires_at"]
+        except FileNotFoundError:
+            pass
+        except Exception:
+            logger.exception("Could not read Jamf token cache %s", self.cache_path)
+        return None, None
+
+    def _write_cache(self, token, expires_at):
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.cache_path)))
+            with os.fdopen(fd, "w") as f:
+                json.dump({"base_url": self.client.base_url,
+                           "client_id": self.client.client_id,
+                           "access_token": token,
+                           "expires_at": expires_at}, f)
+            os.replace(tmp_path, self.cache_path)
+        except Exception:
+            logger.exception("Could not write Jamf token cache %s", self.cache_path)
+
+    def _fetch(self):
+        logger.debug("Fetch access token for %s", self.client.base_url)
+        resp = self.client.request(
+            "POST", "/api/oauth/token",
+            url=f"{self.client.base_url}/api/oauth/token",
+            data={
+                "client_id": self.client.client_id,
+                "grant_type": "client_credentials",
+                "client_secret": self.client.client_secret
+            }
+        )
+        if resp.status_code != 200:
+            raise JamfClientError(f"Could not get access token. Status code: {resp.status_code}")
+        access_token, expires_in = decode_response(resp, ("access_token",), ("expires_in",))
+        if not access_token or not expires_in:
+            raise JamfClientError("Invalid access token response")
+        expires_at = time.time() + expires_in
+        logger.debug("Got access token for %s. Expires: %s",
+                     self.client.base_url, datetime.fromtimestamp(expires_at))
+        return access_token, expires_at
+
+    def _refresh(self, rejected_token, min_validity_seconds):
+        # the cached token is only re-used if valid for min_validity_seconds
+        if self.cache_path:
+            token, expires_at = self._read_cache()
+            if token != rejected_token and self._is_valid(expires_at, min_validity_seconds):
+                logger.debug("Use cached access token for %s", self.client.base_url)
+                return token, expires_at
+        token, expires_at = self._fetch()
+        if self.cache_path:
+            self._write_cache(token, expires_at)
+        return token, expires_at
+
+    def _refresh_with_file_lock(self, rejected_token, min_validity_seconds=None):
+        if not self.cache_path or fcntl is None:
+            return self._refresh(rejected_token, min_validity_seconds)
+        # single-flight across the processes sharing the cache
+        with open(f"{self.cache_path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                return self._refresh(rejected_token, min_validity_seconds)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _get_current_token(self):
+        with self._lock:
+            return self._token, self._expires_at
+
+    def _set_current_token(self, token, expires_at):
+        with self._lock:
+            self._token, self._expires_at = token, expires_at
+
+    def _needs_refresh(self, token, expires_at, rejected_token):
+        return (
+            token is None
+            or not self._is_valid(expires_at)
+            or (rejected_token is not None and rejected_token == token)
+        )
+
+    def get_token(self, rejected_token=None, force=False):
+        # rejected_token: token refused by the API, refreshed only if still the current one
+        token, expires_at = self._get_current_token()
+        if not force and not self._needs_refresh(token, expires_at, rejected_token):
+            logger.debug("Re-use access token for %s", self.client.base_url)
+            return token
+        with self._refresh_lock:
+            current_token, current_expires_at = self._get_current_token()
+            if current_token != token and not self._needs_refresh(current_token, current_expires_at, rejected_token):
+                # refreshed by another thread
+                return current_token
+            token, expires_at = self._refresh_with_file_lock(rejected_token)
+            self._set_current_token(token, expires_at)
+        self._schedule_background_refresh()
+        return token
+
+    def _schedule_background_refresh(self):
+        if not self.background_refresh:
+            return
+        with self._lock:
+            if self._refresh_thread is not None:
+                return
+            self._refresh_thread = threading.Thread(target=self._background_refresh_loop,
+                                                    name="nekobus-jamf-token", daemon=True)
+        self._refresh_thread.start()
+
+    def _get_background_refresh_delay(self):
+        _, expires_at = self._get_current_token()
+        delay = expires_at - self.min_validity_seconds - self.background_refresh_margin - time.time()
+        return max(self.background_min_sleep, delay)
+
+    def _background_refresh(self):
+        # the requests keep using the current token during the refresh
+        min_validity_seconds = self.min_validity_seconds + self.background_refresh_margin
+        with self._refresh_lock:
+            _, expires_at = self._get_current_token()
+            if self._is_valid(expires_at, min_validity_seconds):
+                # refreshed by a request
+                return
+            # the cached token must be valid after the next background refresh
+            token, expires_at = self._refresh_with_file_lock(None, min_validity_seconds)
+            self._set_current_token(token, expires_at)
+
+    def _background_refresh_loop(self):
+        while True:
+            # sleep until the token enters the background refresh window
+            time.sleep(self._get_background_refresh_delay())
+            try:
+                self._background_refresh()
+            except Exception:
+                logger.exception("Could not refresh the Jamf access token in the background")
+
+
+class JamfComputerRecord:
+    # compact Jamf computer, for the inventory index
+    __slots__ = ("id", "mdm_capable")
+
+    def __init__(self, jamf_id, mdm_capable):
+        self.id = jamf_id
+        self.mdm_capable = mdm_capable
+
+
+class JamfComputerIndex:
+    # serial number → JamfComputerRecord, synced from the paginated Jamf Pro computers inventory,
+    # refreshed once per TTL. If tracked_only, only the tracked computers are fetched, filtered by
+    # serial number. Else the whole fleet is fetched, and only the computers with a contact since
+    # the last sync, and the tracked computers, are fetched during the incremental syncs, with a
+    # full sync every full_refresh_interval. The MDM capability of an unmanaged computer can change
+    # without a new contact, the tracked (started and polled) computers are always re-fetched.
+    path = "/v1/computers-inventory"
+    ttl = 60  # 1 min
+    page_size = 500
+    filter_batch_size = 100  # max serial numbers per filter
+    full_refresh_interval = 3600  # 1 hour
+
+    def __init__(self, client, ttl=None, tracked_only=False):
+        self.client = client
+        if ttl:
+            self.ttl = ttl
+        self.tracked_only = tracked_only
+        # protects the index state, never held while paging the API
+        self._lock = threading.Lock()
+        # single-flight refresh
+        self._refresh_lock = threading.Lock()
+        self._tracked_serial_numbers = set()
+        self._invalidated_serial_numbers = set()  # during the current refresh
+        self._index = None
+        self._synced_at = None
+        self._full_synced_at = None
+        self._cursor = None
+
+    def track(self, *serial_numbers):
+        with self._lock:
+            self._tracked_serial_numbers.update(serial_numbers)
+
+    def untrack(self, *serial_numbers):
+        with self._lock:
+            self._tracked_serial_numbers.difference_update(serial_numbers)
+            if self.tracked_only and self._index is not None:
+                for serial_number in serial_numbers:
+                    self._index.pop(serial_number, None)
+
+    def invalidate(self, *serial_numbers):
+        # stale records, fetched individually until the next refresh
+        with self._lock:
+            self._invalidated_serial_numbers.update(serial_numbers)
+            if self._index is not None:
+                for serial_number in serial_numbers:
+                    self._index.pop(serial_number, None)
+
+    def iter_computers(self, rsql_filter=None):
+        params = {
+            # the serial number is only available in the HARDWARE section
+            "section": ["GENERAL", "HARDWARE"],
+            "sort": "id:asc",
+            "page-size": self.page_size,
+        }
+        if rsql_filter:
+            params["filter"] = rsql_filter
+        page = 0
+        while True:
+            params["page"] = page
+            response = self.client.make_query(
+                "GET", self.path, endpoint=f"/api{self.path}",
+                url=f"{self.client.base_url}/api{self.path}", params=params
+            )
+            results = (response or {}).get("results") or []
+            yield from results
+            page += 1
+            if len(results) < self.page_size or page * self.page_size >= response.get("totalCount", 0):
+                break
+
+    def iter_tracked_computers(self, serial_numbers):
+        serial_numbers = sorted(serial_numbers)
+        for i in range(0, len(serial_numbers), self.filter_batch_size):
+            rsql_filter = "hardware.serialNumber=in=({})".format(
+                ",".join(f'"{serial_number}"' for serial_number in serial_numbers[i:i + self.filter_batch_size])
+            )
+            yield from self.iter_computers(rsql_filter)
+
+    def update_index(self, index, computer):
+        serial_number = (computer.get("hardware") or {}).get("serialNumber")
+        if not serial_number:
+            return
+        general = computer.get("general") or {}
+        index[serial_number] = JamfComputerRecord(
+            computer["id"],
+            bool((general.get("mdmCapable") or {}).get("capable")),
+        )
+        return general.get("lastContactTime")
+
+    def _is_fresh(self, now):
+        return self._index is not None and now - self._synced_at < self.ttl
+
+    def refresh(self, force=False):
+        with self._lock:
+            if not force and self._is_fresh(time.monotonic()):
+                return
+            initialized = self._index is not None
+        # the other threads keep using the current index during the refresh
+        if not self._refresh_lock.acquire(blocking=force or not initialized):
+            return
+        # shared work, not bound by the deadline of the request triggering it
+        try:
+            with request_deadline(None):
+                self._refresh(force)
+        finally:
+            self._refresh_lock.release()
+
+    def _refresh(self, force):
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._is_fresh(now):
+                # refreshed by another thread
+                return
+            self._invalidated_serial_numbers.clear()
+            tracked_serial_numbers = set(self._tracked_serial_numbers)
+            incremental = (
+                not force
+                and not self.tracked_only
+                and self._index is not None
+                and self._cursor is not None
+                and now - self._full_synced_at < self.full_refresh_interval
+            )
+            cursor = self._cursor if incremental else None
+        index = {}
+        if self.tracked_only:
+            logger.info("Refresh Jamf computer index. %d tracked device(s)", len(tracked_serial_numbers))
+            for computer in self.iter_tracked_computers(tracked_serial_numbers):
+                self.update_index(index, computer)
+        else:
+            if incremental:
+                logger.info("Refresh Jamf computer index since %s. %d tracked device(s)",
+                            cursor, len(tracked_serial_numbers))
+                computers = itertools.chain(
+                    self.iter_computers(f'general.lastContactTime=ge="{cursor}"'),
+                    self.iter_tracked_computers(tracked_serial_numbers),
+                )
+            else:
+                logger.info("Refresh Jamf computer index")
+                computers = self.iter_computers()
+            for computer in computers:
+                last_contact_time = self.update_index(index, computer)
+                if last_contact_time and (cursor is None or last_contact_time > cursor):
+                    cursor = last_contact_time
+        with self._lock:
+            # invalidated during the refresh, the fetched records could be stale
+            for serial_number in self._invalidated_serial_numbers:
+                index.pop(serial_number, None)
+            if self.tracked_only:
+                # untracked during the refresh
+                index = {k: v for k, v in index.items() if k in self._tracked_serial_numbers}
+            if incremental:
+                self._index.update(index)
+            else:
+                self._index = index
+                if not self.tracked_only:
+                    self._full_synced_at = now
+            self._cursor = cursor
+            self._synced_at = now
+            logger.info("Jamf computer index refreshed. %d device(s)", len(self._index))
+
+    def get(self, serial_number):
+        if self.tracked_only:
+            with self._lock:
+                if serial_number not in self._tracked_serial_numbers:
+                    return None
+        self.refresh()
+        with self._lock:
+            return self._index.get(serial_number)
+
+
 class JamfClient:
     default_timeout = 15  # 15 seconds
     max_retries = 3  # max 3 attempts
-    access_token_min_validity_seconds = 300  # 5 min
+    max_rate = 50  # max 50 requests / second
+    max_concurrency = 10  # max 10 in-flight requests
+    computer_id_cache_maxsize = 50000
+    computer_id_cache_ttl = 86400  # 1 day. The Jamf ID of a computer doesn't change.
+    computer_id_lookup_max_count = 10  # above, the IDs of the whole fleet are fetched with one request
+    unmanage_batch_size = 100  # max computer IDs per UnmanageDevice command
 
-    def __init__(self, base_url, client_id, client_secret, api_path="/JSSResource"):
+    def __init__(self, base_url, client_id, client_secret, api_path="/JSSResource",
+                 token_cache_path=None, background_token_refresh=False, max_concurrency=None, max_rate=None):
         self.base_url = base_url
         self.api_base_url = f"{base_url}{api_path}"
         self.client_id = client_id
@@ -24,77 +382,110 @@ class JamfClient:
         self.session = requests.Session()
         self.session.headers.update({'user-agent': f"nekobus/{__version__}",
                                      'accept': 'application/json'})
-        self.session.mount(
-            self.api_base_url,
-            CustomHTTPAdapter(self.default_timeout, self.max_retries)
-        )
-        self.access_token = None
+        if max_concurrency:
+            self.max_concurrency = max_concurrency
+        if max_rate:
+            self.max_rate = max_rate
+        self.governor = BackendGovernor('Jamf', self.max_rate, self.max_concurrency)
+        # mounted on the base URL to also cover the /api endpoints (OAuth token, …)
+        self.adapter = CustomHTTPAdapter(self.default_timeout, self.max_retries, self.governor)
+        if self.base_url:
+            # no base URL when the client is not configured (report without Jamf)
+            self.session.mount(self.base_url, self.adapter)
+        self.token_manager = JamfTokenManager(self, token_cache_path, background_token_refresh)
+        self.computer_id_cache = TTLCache(self.computer_id_cache_maxsize, self.computer_id_cache_ttl)
+        self.computer_index = None
+
+    def request(self, method, path, endpoint=None, url=None, **kwargs):
+        # endpoint: the metrics label, the path if None
+        if url is None:
+            url = f"{self.api_base_url}{path}"
+        return timed_request(self.session, "jamf", endpoint or path, method, url, **kwargs)
 
     def refresh_access_token_if_necessary(self, force=False):
-        if (
-            force or
-            self.access_token is None
-            or (
-                self.access_token["expires"]
-                + timedelta(seconds=self.access_token_min_validity_seconds) < datetime.now()
-            )
-        ):
-            logger.debug("Fetch access token for %s", self.base_url)
-            self.session.headers.pop("Authorization", None)
-            resp = self.session.post(
-                f"{self.base_url}/api/oauth/token",
-                data={
-                    "client_id": self.client_id,
-                    "grant_type": "client_credentials",
-                    "client_secret": self.client_secret
-                }
-            )
-            if resp.status_code != 200:
-                raise JamfClientError(f"Could not get access token. Status code: {resp.status_code}")
-            self.access_token = resp.json()
-            self.access_token["expires"] = datetime.now() + timedelta(seconds=self.access_token.pop("expires_in"))
-            logger.debug("Got access token for %s. Expires: %s", self.base_url, self.access_token["expires"])
-            self.session.headers["Authorization"] = f'Bearer {self.access_token["access_token"]}'
-        else:
-            logger.debug("Re-use access token for %s. Expires: %s", self.base_url, self.access_token["expires"])
-        return self.access_token["access_token"]
+        return self.token_manager.get_token(force=force)
 
-    def make_query(self, verb, path, missing_ok=False):
-        url = f"{self.api_base_url}{path}"
-        meth = getattr(self.session, verb.lower())
+    def open_connection(self):
+        # open a keep-alive connection to the API, the response doesn't matter
+        try:
+            self.request("HEAD", "/")
+        except requests.exceptions.RequestException:
+            logger.warning("Could not open connection to %s", self.base_url)
+
+    def make_query(self, verb, path, missing_ok=False, endpoint=None, url=None, params=None):
+        # url: to query the Jamf Pro API, the Classic API path is used if None
+        if url is None:
+            url = f"{self.api_base_url}{path}"
+        rejected_token = None
         for i in range(2):
-            self.refresh_access_token_if_necessary()
+            token = self.token_manager.get_token(rejected_token)
             try:
-                r = meth(url)
+                r = self.request(verb, path, endpoint, url=url, params=params,
+                                 headers={"Authorization": f"Bearer {token}"})
             except requests.exceptions.RequestException as e:
                 raise JamfClientError(f"{verb} {url} {e}")
             if missing_ok and r.status_code == 404:
                 return None
             if r.status_code == 200:
-                return r.json()
+                return decode_response(r)
             elif r.status_code == 201:
                 return None
             elif r.status_code == 401:
-                pass
+                rejected_token = token
             else:
                 raise JamfClientError(f"{verb} {url} status code {r.status_code}")
         raise JamfClientError(f"{verb} {url} Unauthorized")
 
-    def get_computer_info(self, serial_number):
+    def get_computer_info(self, serial_number, subsets=None):
+        # subsets: Classic API subsets (General, Hardware, …). All the record if None.
         logger.info("Get Jamf computer %s info", serial_number)
-        response = self.make_query("GET", f"/computers/serialnumber/{serial_number}", missing_ok=True)
+        path = f"/computers/serialnumber/{serial_number}"
+        if subsets:
+            path = f"{path}/subset/{'&'.join(subsets)}"
+        response = self.make_query(
+            "GET", path, missing_ok=True,
+            endpoint="/computers/serialnumber/{serial_number}" + (f"/subset/{'&'.join(subsets)}" if subsets else "")
+        )
         if response is None:
             logger.error("Unknown Jamf computer %s", serial_number)
         else:
             logger.info("Found Jamf computer %s", serial_number)
         return response
 
+    def get_computer_general_info(self, serial_number):
+        response = self.get_computer_info(serial_number, subsets=("General",))
+        if not response:
+            return
+        return response["computer"]["general"]
+
+    def get_indexed_computer(self, serial_number):
+        if self.computer_index is None:
+            return
+        try:
+            return self.computer_index.get(serial_number)
+        except JamfClientError:
+            logger.exception("Could not refresh the Jamf computer index")
+
+    def invalidate_indexed_computers(self, *serial_numbers):
+        if self.computer_index is not None:
+            self.computer_index.invalidate(*serial_numbers)
+
     def get_computer_device_id(self, serial_number):
         logger.info("Get Jamf computer %s ID", serial_number)
-        response = self.get_computer_info(serial_number)
-        if not response:
+        jamf_id = self.computer_id_cache.get(serial_number)
+        if jamf_id:
+            logger.info("Computer %s has cached Jamf ID %s", serial_number, jamf_id)
+            return jamf_id
+        record = self.get_indexed_computer(serial_number)
+        if record:
+            logger.info("Computer %s has indexed Jamf ID %s", serial_number, record.id)
+            self.computer_id_cache.set(serial_number, record.id)
+            return record.id
+        general_info = self.get_computer_general_info(serial_number)
+        if not general_info:
             return
-        jamf_id = response["computer"]["general"]["id"]
+        jamf_id = general_info["id"]
+        self.computer_id_cache.set(serial_number, jamf_id)
         logger.info("Computer %s has Jamf ID %s", serial_number, jamf_id)
         return jamf_id
 
@@ -104,19 +495,103 @@ class JamfClient:
         if not jamf_id:
             return False
         try:
-            self.make_query("POST", f"/computercommands/command/UnmanageDevice/id/{jamf_id}")
+            self._queue_unmanage_command([jamf_id])
         except JamfClientError as e:
             logger.error("Could not queue Unenroll command for computer %s %s: %s", serial_number, jamf_id, e)
             return False
         else:
             logger.info("Unenroll command queued for computer %s", serial_number)
+            # the indexed MDM capability is stale
+            self.invalidate_indexed_computers(serial_number)
             return True
 
+    def get_computer_device_ids(self, serial_numbers):
+        # serial number → Jamf ID of the known computers, with a single bulk lookup for the uncached ones
+        jamf_ids = {}
+        missing_serial_numbers = set()
+        for serial_number in serial_numbers:
+            jamf_id = self.computer_id_cache.get(serial_number)
+            if not jamf_id:
+                record = self.get_indexed_computer(serial_number)
+                if record:
+                    jamf_id = record.id
+            if jamf_id:
+                jamf_ids[serial_number] = jamf_id
+            else:
+                missing_serial_numbers.add(serial_number)
+        if not missing_serial_numbers:
+            return jamf_ids
+        logger.info("Get %d Jamf computer ID(s)", len(missing_serial_numbers))
+        if len(missing_serial_numbers) <= self.computer_id_lookup_max_count:
+            for serial_number in missing_serial_numbers:
+                jamf_id = self.get_computer_device_id(serial_number)
+                if jamf_id:
+                    jamf_ids[serial_number] = jamf_id
+        else:
+            # all the IDs of the listing are cached, for the next calls
+            response = self.make_query("GET", "/computers/subset/basic")
+            for computer in (response or {}).get("computers", []):
+                serial_number = computer.get("serial_number")
+                if not serial_number:
+                    continue
+                jamf_id = computer["id"]
+                self.computer_id_cache.set(serial_number, jamf_id)
+                if serial_number in missing_serial_numbers:
+                    jamf_ids[serial_number] = jamf_id
+        logger.info("Found %d/%d Jamf computer ID(s)", len(jamf_ids), len(set(serial_numbers)))
+        return jamf_ids
+
+    def _queue_unmanage_command(self, jamf_ids):
+        self.make_query("POST", f"/computercommands/command/UnmanageDevice/id/{','.join(map(str, jamf_ids))}",
+                        endpoint="/computercommands/command/UnmanageDevice/id/{id}")
+
+    def unmanage_computer_devices(self, serial_numbers, batch_size=None):
+        # serial number → True if the Unenroll command was queued
+        serial_numbers = list(dict.fromkeys(serial_numbers))
+        logger.info("Unmanage %d computer(s)", len(serial_numbers))
+        results = dict.fromkeys(serial_numbers, False)
+        jamf_ids = self.get_computer_device_ids(serial_numbers)
+        items = list(jamf_ids.items())
+        batch_size = batch_size or self.unmanage_batch_size
+        for i in range(0, len(items), batch_size):
+            batch = items[i:i + batch_size]
+            try:
+                self._queue_unmanage_command([jamf_id for _, jamf_id in batch])
+            except JamfClientError as e:
+                if len(batch) == 1:
+                    logger.error("Could not queue Unenroll command for computer %s %s: %s", *batch[0], e)
+                    continue
+                # one invalid ID fails the whole command, retry one by one to get the outcome of each computer
+                logger.error("Could not queue Unenroll command for %d computer(s): %s. Retry one by one.",
+                             len(batch), e)
+                for serial_number, jamf_id in batch:
+                    try:
+                        self._queue_unmanage_command([jamf_id])
+                    except JamfClientError as e:
+                        logger.error("Could not queue Unenroll command for computer %s %s: %s",
+                                     serial_number, jamf_id, e)
+                    else:
+                        results[serial_number] = True
+            else:
+                for serial_number, _ in batch:
+                    results[serial_number] = True
+        logger.info("Unenroll command queued for %d/%d computer(s)", sum(results.values()), len(results))
+        # the indexed MDM capabilities are stale
+        self.invalidate_indexed_computers(*(serial_number for serial_number, queued in results.items() if queued))
+        return results
+
     def get_mdm_status(self, serial_number):
         logger.info("Get computer %s MDM status", serial_number)
-        response = self.get_computer_info(serial_number)
+        record = self.get_indexed_computer(serial_number)
+        if record:
+            logger.info("Computer %s indexed MDM capable %s", serial_number, record.mdm_capable)
+            return "enrolled" if record.mdm_capable else "unenrolled"
+        if self.computer_index is not None:
+            # polled device, synced with the next index refresh
+            self.computer_index.track(serial_number)
+        general_info = self.get_computer_general_info(serial_number)
         try:
-            mdm_capable = response["computer"]["general"]["mdm_capable"]
+            mdm_capable = general_info["mdm_capable"]
         except Exception:
             logger.warning("Missing computer %s MDM capable info. Default to False", serial_number)
             mdm_capable = False
@@ -0,0 +1,151 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import logging
+import sqlite3
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, serial_number, idempotency_key, status, error=None, created_at=None, updated_at=None):
+        self.serial_number = serial_number
+        self.idempotency_key = idempotency_key
+        self.status = status
+        self.error = error
+        self.created_at = created_at
+        self.updated_at = updated_at
+
+    def serialize(self):
+        d = {
+            "idempotency_key": self.idempotency_key,
+            "status": self.status,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None,
+        }
+        if self.error:
+            d["error"] = self.error
+        return d
+
+
+class JobStore:
+    # start jobs, unique by (serial number, idempotency key)
+    lease_seconds = 300  # running jobs not completed after 5 min can be claimed again
+
+    def get(self, serial_number, idempotency_key):
+        raise NotImplementedError
+
+    def enqueue(self, serial_number, idempotency_key):
+        # returns the job and True if it was created, False if it already existed
+        raise NotImplementedError
+
+    def claim(self, limit):
+        # returns up to limit jobs, in the running state
+        raise NotImplementedError
+
+    def complete(self, job, error=None):
+        raise NotImplementedError
+
+
+class SQLiteJobStore(JobStore):
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                "create table if not exists nekobus_start_jobs ("
+                "serial_number text not null,"
+                "idempotency_key text not null,"
+                "status text not null,"
+                "error text,"
+                "created_at text not null,"
+                "updated_at text not null,"
+                "primary key (serial_number, idempotency_key))"
+            )
+            conn.execute(
+                "create index if not exists nekobus_start_jobs_status on nekobus_start_jobs(status, updated_at)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _job(row):
+        serial_number, idempotency_key, status, error, created_at, updated_at = row
+        return Job(serial_number, idempotency_key, status, error,
+                   datetime.fromisoformat(created_at), datetime.fromisoformat(updated_at))
+
+    def _get(self, conn, serial_number, idempotency_key):
+        row = conn.execute(
+            "select serial_number, idempotency_key, status, error, created_at, updated_at "
+            "from nekobus_start_jobs where serial_number = ? and idempotency_key = ?",
+            (serial_number, idempotency_key)
+        ).fetchone()
+        if row:
+            return self._job(row)
+
+    def get(self, serial_number, idempotency_key):
+        with self._lock, self._connect() as conn:
+            return self._get(conn, serial_number, idempotency_key)
+
+    def enqueue(self, serial_number, idempotency_key):
+        now = datetime.now(timezone.utc).isoformat()
+        with self._lock, self._connect() as conn:
+            cursor = conn.execute(
+                "insert or ignore into nekobus_start_jobs "
+                "(serial_number, idempotency_key, status, created_at, updated_at) "
+                "values (?, ?, ?, ?, ?)",
+                (serial_number, idempotency_key, Job.QUEUED, now, now)
+            )
+            return self._get(conn, serial_number, idempotency_key), cursor.rowcount == 1
+
+    def claim(self, limit):
+        now = datetime.now(timezone.utc)
+        with self._lock, self._connect() as conn:
+            conn.execute("begin immediate")
+            try:
+                rows = conn.execute(
+                    "select serial_number, idempotency_key, status, error, created_at, updated_at "
+                    "from nekobus_start_jobs "
+                    "where status = ? or (status = ? and updated_at < ?) "
+                    "order by created_at limit ?",
+                    (Job.QUEUED, Job.RUNNING, (now - timedelta(seconds=self.lease_seconds)).isoformat(), limit)
+                ).fetchall()
+                jobs = []
+                for row in rows:
+                    job = self._job(row)
+                    job.status = Job.RUNNING
+                    job.updated_at = now
+                    conn.execute(
+                        "update nekobus_start_jobs set status = ?, updated_at = ? "
+                        "where serial_number = ? and idempotency_key = ?",
+                        (job.status, job.updated_at.isoformat(), job.serial_number, job.idempotency_key)
+                    )
+                    jobs.append(job)
+            except Exception:
+                conn.execute("rollback")
+                raise
+            conn.execute("commit")
+        return jobs
+
+    def complete(self, job, error=None):
+        job.status = Job.FAILED if error else Job.DONE
+        job.error = error
+        job.updated_at = datetime.now(timezone.utc)
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "update nekobus_start_jobs set status = ?, error = ?, updated_at = ? "
+                "where serial_number = ? and idempotency_key = ?",
+                (job.status, job.error, job.updated_at.isoformat(), job.serial_number, job.idempotency_key)
+            )
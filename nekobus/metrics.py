@@ -0,0 +1,191 @@
+from contextlib import contextmanager
+import contextvars
+import json
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsCollector:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = []
+        self.spans = []
+
+    def record_call(self, backend, endpoint, method, status_code, retries, size, duration):
+        with self._lock:
+            self.calls.append({
+                "backend": backend,
+                "endpoint": endpoint,
+                "method": method,
+                "status_code": status_code,
+                "retries": retries,
+                "bytes": size,
+                "duration": duration,
+            })
+
+    def record_span(self, operation, duration, error):
+        with self._lock:
+            self.spans.append({
+                "operation": operation,
+                "duration": duration,
+                "error": error,
+            })
+
+
+_collector = contextvars.ContextVar("nekobus_metrics_collector", default=None)
+
+
+@contextmanager
+def collect_metrics():
+    collector = MetricsCollector()
+    token = _collector.set(collector)
+    try:
+        yield collector
+    finally:
+        _collector.reset(token)
+
+
+@contextmanager
+def span(operation):
+    # usable as a decorator
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except Exception:
+        error = True
+        raise
+    finally:
+        collector = _collector.get()
+        if collector is not None:
+            collector.record_span(operation, time.perf_counter() - start, error)
+
+
+def get_retry_count(response):
+    try:
+        return len(response.raw.retries.history)
+    except AttributeError:
+        return 0
+
+
+def timed_request(session, backend, endpoint, method, url, **kwargs):
+    collector = _collector.get()
+    if collector is None:
+        return session.request(method, url, **kwargs)
+    start = time.perf_counter()
+    try:
+        response = session.request(method, url, **kwargs)
+    except Exception:
+        collector.record_call(backend, endpoint, method, None, 0, 0, time.perf_counter() - start)
+        raise
+    collector.record_call(
+        backend, endpoint, method,
+        response.status_code,
+        get_retry_count(response),
+        len(response.content),
+        time.perf_counter() - start
+    )
+    return response
+
+
+# sinks
+
+
+class InMemoryMetricsSink:
+    def __init__(self):
+        self.calls = []
+        self.spans = []
+        self.throttling = []
+
+    def emit(self, collector):
+        self.calls.extend(collector.calls)
+        self.spans.extend(collector.spans)
+
+    def emit_throttling(self, throttling_metrics):
+        self.throttling.append(throttling_metrics)
+
+
+class EMFMetricsSink:
+    # CloudWatch Embedded Metric Format, written to stdout.
+    # One record per (backend, endpoint) and per operation, with all the values,
+    # split in records of at most 100 values per metric (EMF limit).
+    max_values = 100
+
+    def __init__(self, namespace="Nekobus", stream=None):
+        self.namespace = namespace
+        self.stream = stream
+        # cumulative governor counts, to emit the increments
+        self._throttling_lock = threading.Lock()
+        self._throttling_counts = {}
+
+    def _emit_record(self, dimensions, metrics, properties):
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [list(dimensions)],
+                    "Metrics": [{"Name": name, "Unit": unit} for name, (unit, _) in metrics.items()],
+                }],
+            },
+        }
+        record.update(dimensions)
+        record.update({name: values for name, (_, values) in metrics.items()})
+        record.update(properties)
+        print(json.dumps(record), file=self.stream, flush=True)
+
+    def _emit_records(self, dimensions, items, metrics, properties):
+        # metrics & properties: name → (unit, value function) & name → value function
+        for i in range(0, len(items), self.max_values):
+            chunk = items[i:i + self.max_values]
+            self._emit_record(
+                dimensions,
+                {name: (unit, [func(item) for item in chunk]) for name, (unit, func) in metrics.items()},
+                {name: [func(item) for item in chunk] for name, func in properties.items()}
+            )
+
+    def emit(self, collector):
+        calls = {}
+        for call in collector.calls:
+            calls.setdefault((call["backend"], call["endpoint"]), []).append(call)
+        for (backend, endpoint), endpoint_calls in calls.items():
+            self._emit_records(
+                {"Backend": backend, "Endpoint": endpoint},
+                endpoint_calls,
+                {"Duration": ("Milliseconds", lambda c: round(c["duration"] * 1000, 3)),
+                 "Bytes": ("Bytes", lambda c: c["bytes"]),
+                 "Retries": ("Count", lambda c: c["retries"]),
+                 "Errors": ("Count", lambda c: int(not c["status_code"] or c["status_code"] >= 400))},
+                {"StatusCodes": lambda c: c["status_code"]}
+            )
+        spans = {}
+        for s in collector.spans:
+            spans.setdefault(s["operation"], []).append(s)
+        for operation, operation_spans in spans.items():
+            self._emit_records(
+                {"Operation": operation},
+                operation_spans,
+                {"Duration": ("Milliseconds", lambda s: round(s["duration"] * 1000, 3)),
+                 "Errors": ("Count", lambda s: int(s["error"]))},
+                {}
+            )
+
+    def emit_throttling(self, throttling_metrics):
+        # current governor limits, and throttled responses & decreases since the last emit
+        for backend, metrics in throttling_metrics.items():
+            with self._throttling_lock:
+                last_counts = self._throttling_counts.get(backend, {})
+                self._throttling_counts[backend] = {k: metrics[k] for k in ("throttled_count", "decrease_count")}
+            self._emit_record(
+                {"Backend": backend},
+                {"Rate": ("Count/Second", metrics["rate"]),
+                 "ConcurrencyLimit": ("Count", metrics["concurrency_limit"]),
+                 "InFlight": ("Count", metrics["in_flight"]),
+                 "Throttled": ("Count", metrics["throttled_count"] - last_counts.get("throttled_count", 0)),
+                 "Decreases": ("Count", metrics["decrease_count"] - last_counts.get("decrease_count", 0))},
+                {}
+            )
@@ -1,6 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import contextvars
 import logging
-from .jamf import JamfClient
-from .zentral import ZentralClient
+import threading
+import time
+from .jamf import JamfClient, JamfComputerIndex
+from .metrics import span
+from .utils import request_deadline
+from .zentral import DEPDeviceIndex, MDMEnrolledDeviceIndex, ZentralClient, ZentralTagBatcher
 
 
 logger = logging.getLogger(__name__)
@@ -13,6 +19,14 @@ class MigrationError(Exception):
 
 
 class MigrationManager:
+    max_workers = 10  # max concurrent devices for the batch operations
+    # Jamf webhook events triggering a verification of the MDM status of the started devices
+    jamf_webhook_verification_events = (
+        "ComputerCheckIn",
+        "ComputerInventoryCompleted",
+        "ComputerPushCapabilityChanged",
+    )
+
     def __init__(
         self,
         jamf_base_url,
@@ -26,9 +40,33 @@ class MigrationManager:
         started_tag,
         unenrolled_tag,
         finished_tag,
+        max_workers=None,
+        dep_device_index_ttl=None,
+        mdm_enrolled_device_index_ttl=None,
+        jamf_token_cache_path=None,
+        jamf_background_token_refresh=False,
+        status_timeout=None,
+        max_connections=None,
+        jamf_computer_index_ttl=None,
+        jamf_computer_index_tracked_only=False,
+        jamf_max_rate=None,
+        zentral_max_rate=None,
+        jamf_webhooks=False,
     ):
-        self.jamf_client = JamfClient(jamf_base_url, jamf_client_id, jamf_client_secret)
-        self.zentral_client = ZentralClient(zentral_base_url, zentral_token)
+        # max in-flight requests and pooled connections per backend, sized to the workers by default
+        max_connections = max_connections or max_workers
+        self.jamf_client = JamfClient(
+            jamf_base_url, jamf_client_id, jamf_client_secret,
+            token_cache_path=jamf_token_cache_path,
+            background_token_refresh=jamf_background_token_refresh,
+            max_concurrency=max_connections,
+            max_rate=jamf_max_rate,
+        )
+        self.zentral_client = ZentralClient(
+            zentral_base_url, zentral_token,
+            max_concurrency=max_connections,
+            max_rate=zentral_max_rate,
+        )
         self.profile_uuid = profile_uuid
         self.taxonomy = taxonomy
         self.ready_tag = ready_tag
@@ -41,24 +79,64 @@ class MigrationManager:
             self.unenrolled_tag,
             self.finished_tag,
         )
+        if max_workers:
+            self.max_workers = max_workers
+        # if set, the unenrolled tags set by the Jamf webhooks are trusted, and Jamf is not called
+        self.jamf_webhooks = jamf_webhooks
+        # if set, the status probes run concurrently, and status returns after this number of seconds
+        self.status_timeout = status_timeout
+        self._probe_executor = None
+        self._probe_executor_lock = threading.Lock()
+        if dep_device_index_ttl:
+            self.zentral_client.dep_device_index = DEPDeviceIndex(
+                self.zentral_client, self.profile_uuid, dep_device_index_ttl
+            )
+        if mdm_enrolled_device_index_ttl:
+            self.zentral_client.mdm_enrolled_device_index = MDMEnrolledDeviceIndex(
+                self.zentral_client, mdm_enrolled_device_index_ttl
+            )
+        if jamf_computer_index_ttl:
+            # if tracked_only, only the started devices are synced
+            self.jamf_client.computer_index = JamfComputerIndex(
+                self.jamf_client, jamf_computer_index_ttl, jamf_computer_index_tracked_only
+            )
 
+    def warm_up(self):
+        logger.info("Warm up")
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [
+                executor.submit(self.jamf_client.refresh_access_token_if_necessary),
+                executor.submit(self.jamf_client.open_connection),
+                executor.submit(self.zentral_client.open_connection),
+            ]
+            for future in futures:
+                future.result()
+
+    @span("check")
     def check(self, serial_number):
         logger.info("Check device %s", serial_number)
-        # tags
+        # independent lookups, run concurrently
+        dep_status_future = self._submit_probe(
+            None, self.zentral_client.get_dep_status, serial_number, self.profile_uuid
+        )
         tags = self.zentral_client.get_tags(serial_number)
+        dep_status = dep_status_future.result()
+        return self.build_check_result(serial_number, tags, dep_status)
+
+    def build_check_result(self, serial_number, tags, dep_status):
+        # tags
         has_expected_tag = False
         if tags is None:
             logger.warning("Device %s not found in inventory", serial_number)
             migration_tags = []
         else:
-            migration_tags = [t["name"] for t in tags if t["name"] in self.migration_tags]
+            migration_tags = self.filter_migration_tags(tags)
             has_expected_tag = self.ready_tag in migration_tags
             if has_expected_tag:
                 logger.info("Device %s has the %s tag", serial_number, self.ready_tag)
             else:
                 logger.warning("Device %s doesn't have the %s tag", serial_number, self.ready_tag)
         # DEP status
-        dep_status = self.zentral_client.get_dep_status(serial_number, self.profile_uuid)
         has_expected_dep_status = dep_status == "OK"
         if has_expected_dep_status:
             logger.info("Device %s DEP status %s", serial_number, dep_status)
@@ -73,31 +151,311 @@ class MigrationManager:
             "check": has_expected_tag and has_expected_dep_status
         }
 
-    def start(self, serial_number):
+    def filter_migration_tags(self, tags):
+        return [t["name"] for t in tags or [] if t["name"] in self.migration_tags]
+
+    def get_migration_tags(self, serial_number):
+        # the migration tags are the device states shared by all the processes
+        return self.filter_migration_tags(self.zentral_client.get_tags(serial_number))
+
+    def is_unenrolled(self, migration_tags):
+        # unenrolled from Jamf, according to a previous status or a Jamf webhook
+        return self.unenrolled_tag in migration_tags or self.finished_tag in migration_tags
+
+    def set_migration_tag(self, serial_number, tag, tag_batcher=None):
+        (tag_batcher or self.zentral_client).set_taxonomy_tags(serial_number, self.taxonomy, [tag])
+
+    @span("start")
+    def start(self, serial_number, tag_batcher=None):
         logger.info("Start device %s migration", serial_number)
         # IMPORTANT, we need to check otherwise this could be used to unenroll the whole fleet
         # without making sure that they can enroll again
-        if not self.check(serial_number):
+        if not self.check(serial_number)["check"]:
             raise MigrationError("Device not ready for migration")
-        self.jamf_client.unmanage_computer_device(serial_number)
-        self.zentral_client.set_taxonomy_tags(serial_number, self.taxonomy, [self.started_tag])
+        if not self.jamf_client.unmanage_computer_device(serial_number):
+            # not found in Jamf, or the command could not be queued
+            raise MigrationError("Could not unenroll the device", 500)
+        self.set_migration_tag(serial_number, self.started_tag, tag_batcher)
+        self.track_started_devices(serial_number)
         logger.info("Device %s migration started", serial_number)
 
-    def status(self, serial_number):
+    def track_started_devices(self, *serial_numbers):
+        if self.jamf_client.computer_index is not None:
+            self.jamf_client.computer_index.track(*serial_numbers)
+
+    @span("queue_start")
+    def queue_start(self, serial_number, idempotency_key, job_store):
+        logger.info("Queue device %s migration start, key %s", serial_number, idempotency_key)
+        job = job_store.get(serial_number, idempotency_key)
+        if job:
+            logger.info("Device %s migration start already queued, key %s", serial_number, idempotency_key)
+            return job
+        # IMPORTANT, see start
+        if not self.check(serial_number)["check"]:
+            raise MigrationError("Device not ready for migration")
+        job, _ = job_store.enqueue(serial_number, idempotency_key)
+        return job
+
+    def run_start_jobs(self, job_store, batch_size=100, max_jobs=None, timeout=None):
+        # stops when there is no more queued job, after max_jobs jobs, or after timeout seconds.
+        # A batch is not interrupted, the timeout must leave time for one.
+        deadline = time.monotonic() + timeout if timeout else None
+        job_count = 0
+        while True:
+            if max_jobs is not None and job_count >= max_jobs:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                logger.warning("Start jobs timeout")
+                break
+            limit = batch_size if max_jobs is None else min(batch_size, max_jobs - job_count)
+            jobs = job_store.claim(limit)
+            if not jobs:
+                break
+            # start runs the check again
+            results = self.start_many([job.serial_number for job in jobs])
+            errors = {result["serial_number"]: result.get("error") for result in results}
+            for job in jobs:
+                job_store.complete(job, errors.get(job.serial_number))
+            job_count += len(jobs)
+        logger.info("%d start job(s) processed", job_count)
+        return job_count
+
+    @span("status")
+    def status(self, serial_number, tag_batcher=None):
+        if self.status_timeout:
+            return self.probe_status(serial_number, self.status_timeout, tag_batcher)
         logger.info("Get device %s MDM status", serial_number)
         # Just to be sure
         if not self.zentral_client.get_dep_status(serial_number, self.profile_uuid) == "OK":
             raise MigrationError("Device doesn't have the expected DEP enrollment")
-        jamf_status = self.jamf_client.get_mdm_status(serial_number)
-        if jamf_status == "unenrolled":
-            self.zentral_client.set_taxonomy_tags(serial_number, self.taxonomy, [self.unenrolled_tag])
+        if self.jamf_webhooks and self.is_unenrolled(self.get_migration_tags(serial_number)):
+            # tag already set, no Jamf call
+            logger.info("Device %s already tagged as unenrolled", serial_number)
+            jamf_status = "unenrolled"
+        else:
+            jamf_status = self.jamf_client.get_mdm_status(serial_number)
+            if jamf_status == "unenrolled":
+                self.set_migration_tag(serial_number, self.unenrolled_tag, tag_batcher)
         zentral_status = self.zentral_client.get_mdm_status(serial_number)
         return {
             "jamf_status": jamf_status,
             "zentral_status": zentral_status,
         }
 
-    def finish(self, serial_number):
+    def _submit_probe(self, deadline, func, *args):
+        with self._probe_executor_lock:
+            if self._probe_executor is None:
+                self._probe_executor = ThreadPoolExecutor(
+                    max_workers=3 * self.max_workers, thread_name_prefix="nekobus-probe"
+                )
+        return self._probe_executor.submit(contextvars.copy_context().run, self._run_probe, deadline, func, *args)
+
+    @staticmethod
+    def _run_probe(deadline, func, *args):
+        # the probe requests time out at the deadline, to not keep running in the shared executor
+        with request_deadline(deadline):
+            return func(*args)
+
+    @staticmethod
+    def _get_probe_result(serial_number, name, future):
+        if not future.done():
+            logger.error("Device %s %s timeout", serial_number, name)
+            return "timeout"
+        try:
+            return future.result()
+        except Exception:
+            logger.exception("Device %s %s error", serial_number, name)
+            return "error"
+
+    def probe_status(self, serial_number, timeout, tag_batcher=None):
+        # status with a deadline. The independent probes run concurrently.
+        # The probes not finished before the deadline are reported as "timeout".
+        logger.info("Probe device %s MDM status, timeout %ss", serial_number, timeout)
+        deadline = time.monotonic() + timeout
+        futures = {
+            "dep_status": self._submit_probe(
+                deadline, self.zentral_client.get_dep_status, serial_number, self.profile_uuid
+            ),
+            "zentral_status": self._submit_probe(deadline, self.zentral_client.get_mdm_status, serial_number),
+            "jamf_status": self._submit_probe(deadline, self.jamf_client.get_mdm_status, serial_number),
+        }
+        if self.jamf_webhooks:
+            futures["migration_tags"] = self._submit_probe(deadline, self.get_migration_tags, serial_number)
+        wait(futures.values(), timeout=max(0, deadline - time.monotonic()))
+        results = {name: self._get_probe_result(serial_number, name, future) for name, future in futures.items()}
+        migration_tags = results.pop("migration_tags", None)
+        tagged_unenrolled = isinstance(migration_tags, list) and self.is_unenrolled(migration_tags)
+        if tagged_unenrolled:
+            # the Jamf result is discarded
+            results["jamf_status"] = "unenrolled"
+        dep_status = results.pop("dep_status")
+        if dep_status not in ("OK", "timeout", "error"):
+            raise MigrationError("Device doesn't have the expected DEP enrollment")
+        if dep_status == "OK" and results["jamf_status"] == "unenrolled" and not tagged_unenrolled:
+            future = self._submit_probe(
+                deadline, self.set_migration_tag, serial_number, self.unenrolled_tag, tag_batcher
+            )
+            wait([future], timeout=max(0, deadline - time.monotonic()))
+            if self._get_probe_result(serial_number, "tag update", future) in ("timeout", "error"):
+                # the device will poll again
+                results["jamf_status"] = "timeout"
+        elif dep_status != "OK":
+            results["dep_status"] = dep_status
+        return results
+
+    @span("finish")
+    def finish(self, serial_number, tag_batcher=None):
         logger.info("Finish device %s migration", serial_number)
-        self.zentral_client.set_taxonomy_tags(serial_number, self.taxonomy, [self.finished_tag])
+        self.set_migration_tag(serial_number, self.finished_tag, tag_batcher)
+        if self.jamf_client.computer_index is not None:
+            self.jamf_client.computer_index.untrack(serial_number)
         logger.info("Device %s migration finished", serial_number)
+
+    # Jamf webhooks
+
+    @span("jamf_webhook")
+    def process_jamf_webhook(self, payload):
+        # ComputerCheckIn events have the computer in event.computer,
+        # ComputerInventoryCompleted and ComputerPushCapabilityChanged events in event.
+        webhook_event = payload["webhook"]["webhookEvent"]
+        event = payload.get("event") or {}
+        computer = event.get("computer") or event
+        serial_number = computer.get("serialNumber")
+        logger.info("Jamf webhook event %s device %s", webhook_event, serial_number or "-")
+        result = {"webhook_event": webhook_event, "serial_number": serial_number}
+        if not serial_number or webhook_event not in self.jamf_webhook_verification_events:
+            return result
+        migration_tags = self.get_migration_tags(serial_number)
+        # only the started devices are verified, to avoid a Jamf call per fleet event
+        if self.started_tag in migration_tags and self.jamf_client.get_mdm_status(serial_number) == "unenrolled":
+            self.set_migration_tag(serial_number, self.unenrolled_tag)
+            logger.info("Device %s unenrolled", serial_number)
+            migration_tags = [self.unenrolled_tag]
+        result["migration_tags"] = migration_tags
+        return result
+
+    def cache_stats(self):
+        return {
+            "jamf_computer_id": self.jamf_client.computer_id_cache.stats(),
+            "zentral_dep_assignment": self.zentral_client.dep_assignment_cache.stats(),
+        }
+
+    def throttling_metrics(self):
+        return {
+            "jamf": self.jamf_client.governor.metrics(),
+            "zentral": self.zentral_client.governor.metrics(),
+        }
+
+    def connection_pool_metrics(self):
+        return {
+            "jamf": self.jamf_client.adapter.pool_metrics(),
+            "zentral": self.zentral_client.adapter.pool_metrics(),
+        }
+
+    # batch operations
+
+    def _run_one(self, op, serial_number, **kwargs):
+        result = {"serial_number": serial_number}
+        try:
+            op_result = getattr(self, op)(serial_number, **kwargs)
+        except Exception as e:
+            self.set_result_error(result, op, e)
+        else:
+            if op_result:
+                result.update(op_result)
+        return result
+
+    @staticmethod
+    def set_result_error(result, op, exception):
+        serial_number = result["serial_number"]
+        if isinstance(exception, MigrationError):
+            logger.error("Operation %s device %s error: %s", op, serial_number, exception)
+            result["error"] = str(exception)
+            result["status_code"] = exception.status_code
+        else:
+            logger.error("Operation %s device %s error", op, serial_number, exc_info=exception)
+            result["error"] = "Internal server error"
+            result["status_code"] = 500
+
+    @staticmethod
+    def set_failed_tag_writes_errors(results, tag_batcher):
+        for result in results:
+            if result["serial_number"] in tag_batcher.failed_serial_numbers and "error" not in result:
+                result["error"] = "Internal server error"
+                result["status_code"] = 500
+
+    def _run_many(self, op, serial_numbers, write_tags=False):
+        serial_numbers = list(dict.fromkeys(serial_numbers))
+        if not serial_numbers:
+            return []
+        logger.info("Operation %s on %d device(s)", op, len(serial_numbers))
+        kwargs = {}
+        if write_tags:
+            tag_batcher = kwargs["tag_batcher"] = ZentralTagBatcher(self.zentral_client)
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(serial_numbers))) as executor:
+            futures = [
+                executor.submit(contextvars.copy_context().run, self._run_one, op, serial_number, **kwargs)
+                for serial_number in serial_numbers
+            ]
+            results = [future.result() for future in futures]
+        if write_tags:
+            tag_batcher.flush()
+            self.set_failed_tag_writes_errors(results, tag_batcher)
+        return results
+
+    def check_many(self, serial_numbers):
+        return self._run_many("check", serial_numbers)
+
+    def start_many(self, serial_numbers):
+        # the devices are checked concurrently, and the ready ones are unenrolled
+        # with bulk Jamf UnmanageDevice commands
+        check_results = self.check_many(serial_numbers)
+        if not check_results:
+            return []
+        logger.info("Start %d device(s) migration", len(check_results))
+        results = []
+        ready_serial_numbers = []
+        for check_result in check_results:
+            serial_number = check_result["serial_number"]
+            result = {"serial_number": serial_number}
+            results.append(result)
+            if "error" in check_result:
+                result["error"] = check_result["error"]
+                result["status_code"] = check_result["status_code"]
+            elif not check_result["check"]:
+                self.set_result_error(result, "start", MigrationError("Device not ready for migration"))
+            else:
+                ready_serial_numbers.append(serial_number)
+        if not ready_serial_numbers:
+            return results
+        try:
+            unmanaged = self.jamf_client.unmanage_computer_devices(ready_serial_numbers)
+        except Exception as e:
+            ready_serial_number_set = set(ready_serial_numbers)
+            for result in results:
+                if result["serial_number"] in ready_serial_number_set:
+                    self.set_result_error(result, "start", e)
+            return results
+        started_serial_numbers = []
+        tag_batcher = ZentralTagBatcher(self.zentral_client)
+        for result in results:
+            serial_number = result["serial_number"]
+            if serial_number not in unmanaged:
+                continue
+            if not unmanaged[serial_number]:
+                # not found in Jamf, or the command could not be queued
+                self.set_result_error(result, "start", MigrationError("Could not unenroll the device", 500))
+                continue
+            self.set_migration_tag(serial_number, self.started_tag, tag_batcher)
+            started_serial_numbers.append(serial_number)
+        self.track_started_devices(*started_serial_numbers)
+        tag_batcher.flush()
+        self.set_failed_tag_writes_errors(results, tag_batcher)
+        logger.info("%d device(s) migration started", len(started_serial_numbers))
+        return results
+
+    def status_many(self, serial_numbers):
+        return self._run_many("status", serial_numbers, write_tags=True)
+
+    def finish_many(self, serial_numbers):
+        return self._run_many("finish", serial_numbers, write_tags=True)
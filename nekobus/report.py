@@ -0,0 +1,79 @@
+import csv
+import json
+import logging
+from .zentral import DEPDeviceIndex, MDMEnrolledDeviceIndex, get_dep_assignment_status
+
+
+logger = logging.getLogger(__name__)
+
+
+class MigrationReport:
+    # Streams the machines with a migration tag from the Zentral inventory, page by page,
+    # joined with the DEP devices and the MDM enrolled devices. The Zentral API has no bulk
+    # lookup by serial numbers, so the DEP devices and the MDM enrolled devices of the whole fleet
+    # are loaded first, as compact records (a few hundred bytes per device). Only the rows are streamed.
+    # The DEP devices are not filtered by profile, to report the devices assigned to another profile.
+    states = ("ready", "started", "unenrolled", "finished", "stuck")
+    fields = ("serial_number", "state", "migration_tag", "dep_status", "mdm_status")
+
+    def __init__(self, migration_manager):
+        self.mm = migration_manager
+        self.zentral_client = migration_manager.zentral_client
+
+    def get_dep_device_index(self):
+        # not the DEP device index of the client, filtered by profile
+        dep_device_index = DEPDeviceIndex(self.zentral_client)
+        dep_device_index.refresh()
+        return dep_device_index
+
+    def get_mdm_enrolled_device_index(self):
+        mdm_enrolled_device_index = self.zentral_client.mdm_enrolled_device_index
+        if mdm_enrolled_device_index is None:
+            mdm_enrolled_device_index = MDMEnrolledDeviceIndex(self.zentral_client)
+        mdm_enrolled_device_index.refresh()
+        return mdm_enrolled_device_index
+
+    def get_state(self, migration_tag, dep_status):
+        state = {
+            self.mm.ready_tag: "ready",
+            self.mm.started_tag: "started",
+            self.mm.unenrolled_tag: "unenrolled",
+            self.mm.finished_tag: "finished",
+        }[migration_tag]
+        if state != "finished" and dep_status != "OK":
+            # cannot re-enroll
+            state = "stuck"
+        return state
+
+    def iter_rows(self):
+        dep_device_index = self.get_dep_device_index()
+        mdm_enrolled_device_index = self.get_mdm_enrolled_device_index()
+        for migration_tag in self.mm.migration_tags:
+            logger.info("Report on machines with tag %s", migration_tag)
+            for machine in self.zentral_client.iter_tagged_machines(migration_tag):
+                serial_number = machine["serial_number"]
+                dep_status = get_dep_assignment_status(dep_device_index.get(serial_number), self.mm.profile_uuid)
+                yield {
+                    "serial_number": serial_number,
+                    "state": self.get_state(migration_tag, dep_status),
+                    "migration_tag": migration_tag,
+                    "dep_status": dep_status,
+                    # snapshot of the whole fleet, a missing device was not enrolled when synced
+                    "mdm_status": mdm_enrolled_device_index.get_status(serial_number) or "not_found",
+                }
+
+    def write(self, stream, output_format="ndjson"):
+        counts = dict.fromkeys(self.states, 0)
+        if output_format == "csv":
+            writer = csv.DictWriter(stream, fieldnames=self.fields)
+            writer.writeheader()
+            write_row = writer.writerow
+        else:
+            def write_row(row):
+                stream.write(json.dumps(row))
+                stream.write("\n")
+        for row in self.iter_rows():
+            counts[row["state"]] += 1
+            write_row(row)
+        stream.flush()
+        return counts
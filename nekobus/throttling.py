@@ -0,0 +1,157 @@
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def parse_retry_after(value):
+    if not value:
+        return
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        logger.warning("Invalid Retry-After header value: %s", value)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill()
+            self.rate = rate
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def acquire(self, deadline=None):
+        # blocks until a token is available. Returns the time spent waiting.
+        # None, without waiting, if the token is not available before the deadline (time.monotonic()).
+        waited = 0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                return None
+            time.sleep(delay)
+            waited += delay
+
+
+class BackendGovernor:
+    # token bucket + concurrency limit for the requests to a backend,
+    # adjusted using AIMD: multiplicative decrease on 429, additive increase on success.
+    # A single decrease is applied per congestion event: the 429 responses to the requests sent
+    # before the last decrease are ignored. The increase is a constant step per interval.
+    min_rate = 1  # requests / second
+    min_concurrency = 1
+    decrease_factor = 0.5
+    increase_interval = 1  # 1 second
+    rate_increase_ratio = 0.1  # max_rate / 10 per interval
+    concurrency_increase = 1  # per interval
+
+    def __init__(self, name, max_rate=50, max_concurrency=10):
+        self.name = name
+        self.max_rate = max_rate
+        self.max_concurrency = max_concurrency
+        self.rate = max_rate
+        self.concurrency_limit = max_concurrency
+        self.bucket = TokenBucket(max_rate)
+        self.in_flight = 0
+        self.throttled_count = 0
+        self.decrease_count = 0
+        self.blocked_until = 0
+        self._decreased_at = None
+        self._increased_at = time.monotonic()
+        self._condition = threading.Condition()
+
+    def acquire(self, deadline=None):
+        # returns the send time, to pass to release. None if the deadline (time.monotonic()) is reached first.
+        with self._condition:
+            while self.in_flight >= int(self.concurrency_limit):
+                if deadline is None:
+                    self._condition.wait()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+            self.in_flight += 1
+        delay = self.blocked_until - time.monotonic()
+        if delay > 0:
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                self.release()
+                return None
+            time.sleep(delay)
+        if self.bucket.acquire(deadline) is None:
+            self.release()
+            return None
+        return time.monotonic()
+
+    def release(self, response=None, sent_at=None):
+        with self._condition:
+            self.in_flight -= 1
+            if response is not None:
+                if response.status_code == 429:
+                    self._decrease(parse_retry_after(response.headers.get("Retry-After")), sent_at)
+                elif response.status_code < 500:
+                    self._increase()
+            self._condition.notify_all()
+
+    def _decrease(self, retry_after, sent_at):
+        now = time.monotonic()
+        self.throttled_count += 1
+        if retry_after:
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+        if sent_at is not None and self._decreased_at is not None and sent_at < self._decreased_at:
+            # sent before the last decrease, same congestion event
+            return
+        self.decrease_count += 1
+        self._decreased_at = now
+        self._increased_at = now
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit * self.decrease_factor)
+        self.bucket.set_rate(self.rate)
+        logger.warning("%s throttled. Rate %.1f/s, concurrency %d, retry after %s",
+                       self.name, self.rate, self.concurrency_limit, retry_after or "-")
+
+    def _increase(self):
+        if self.rate >= self.max_rate and self.concurrency_limit >= self.max_concurrency:
+            return
+        now = time.monotonic()
+        if now - self._increased_at < self.increase_interval:
+            return
+        self._increased_at = now
+        self.rate = min(self.max_rate, self.rate + self.max_rate * self.rate_increase_ratio)
+        self.bucket.set_rate(self.rate)
+        self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + self.concurrency_increase)
+
+    def metrics(self):
+        with self._condition:
+            return {
+                "rate": round(self.rate, 2),
+                "max_rate": self.max_rate,
+                "concurrency_limit": int(self.concurrency_limit),
+                "max_concurrency": self.max_concurrency,
+                "in_flight": self.in_flight,
+                "throttled_count": self.throttled_count,
+                "decrease_count": self.decrease_count,
+            }
@@ -1,16 +1,237 @@
-from requests.adapters import HTTPAdapter
+from collections import OrderedDict
+from contextlib import contextmanager
+import contextvars
+import json
+import threading
+import time
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+from requests.exceptions import Timeout
 from requests.packages.urllib3.util import Retry
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# request deadline
+
+
+_request_deadline = contextvars.ContextVar("nekobus_request_deadline", default=None)
+
+
+@contextmanager
+def request_deadline(deadline):
+    # deadline: time.monotonic() value. The requests sent in this context, or in the
+    # threads started with a copy of it, time out at the deadline instead of running in the background.
+    token = _request_deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _request_deadline.reset(token)
+
+
+def get_remaining_time():
+    deadline = _request_deadline.get()
+    if deadline is not None:
+        return deadline - time.monotonic()
+
+
+class DeadlineRetry(Retry):
+    # no retry and no backoff past the request deadline
+    def is_exhausted(self):
+        remaining = get_remaining_time()
+        return super().is_exhausted() or (remaining is not None and remaining <= 0)
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        remaining = get_remaining_time()
+        if remaining is not None:
+            backoff = min(backoff, max(0, remaining))
+        return backoff
 
 
 class CustomHTTPAdapter(HTTPAdapter):
-    def __init__(self, default_timeout, max_retries):
+    def __init__(self, default_timeout, max_retries, governor=None, pool_maxsize=None):
         self.default_timeout = default_timeout
+        self.governor = governor
+        self.max_throttled_retries = max_retries
+        if not pool_maxsize:
+            # one pooled connection per in-flight request allowed by the governor
+            pool_maxsize = governor.max_concurrency if governor else DEFAULT_POOLSIZE
+        self.pool_maxsize = pool_maxsize
+        self._pool_lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.saturated_count = 0
         super().__init__(
-            max_retries=Retry(total=max_retries, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
+            max_retries=DeadlineRetry(
+                total=max_retries, backoff_factor=1, status_forcelist=[500, 502, 503, 504],
+                # with a governor, the 429 Retry-After headers are handled by the governor
+                respect_retry_after_header=governor is None,
+            ),
+            pool_maxsize=pool_maxsize,
+            # wait for a pooled connection instead of opening and discarding extra connections.
+            # Only with a governor, that limits the number of in-flight requests.
+            pool_block=governor is not None,
         )
 
-    def send(self, *args, **kwargs):
+    @staticmethod
+    def get_deadline_timeout(timeout):
+        # the timeout capped to the time left before the request deadline
+        remaining = get_remaining_time()
+        if remaining is None:
+            return timeout
+        if remaining <= 0:
+            raise Timeout("Request deadline exceeded")
+        if isinstance(timeout, tuple):
+            return tuple(remaining if t is None else min(t, remaining) for t in timeout)
+        return min(timeout, remaining)
+
+    def send(self, request, **kwargs):
         timeout = kwargs.get("timeout")
         if timeout is None:
-            kwargs["timeout"] = self.default_timeout
-        return super().send(*args, **kwargs)
+            timeout = self.default_timeout
+        if self.governor is None:
+            kwargs["timeout"] = self.get_deadline_timeout(timeout)
+            return self._send(request, **kwargs)
+        # 429 responses are retried here, after the wait imposed by the governor
+        for attempt in range(self.max_throttled_retries + 1):
+            remaining = get_remaining_time()
+            sent_at = self.governor.acquire(None if remaining is None else time.monotonic() + remaining)
+            if sent_at is None:
+                raise Timeout("Request deadline exceeded")
+            try:
+                kwargs["timeout"] = self.get_deadline_timeout(timeout)
+            except Exception:
+                self.governor.release()
+                raise
+            try:
+                response = self._send(request, **kwargs)
+            except Exception:
+                self.governor.release()
+                raise
+            self.governor.release(response, sent_at)
+            if response.status_code != 429 or attempt == self.max_throttled_retries:
+                break
+            response.close()
+        return response
+
+    def _send(self, request, **kwargs):
+        with self._pool_lock:
+            if self.in_flight >= self.pool_maxsize:
+                self.saturated_count += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            with self._pool_lock:
+                self.in_flight -= 1
+
+    def pool_metrics(self):
+        connections_created = requests_sent = idle_connections = 0
+        for key in self.poolmanager.pools.keys():
+            pool = self.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            connections_created += pool.num_connections
+            requests_sent += pool.num_requests
+            idle_connections += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+        with self._pool_lock:
+            return {
+                "pool_maxsize": self.pool_maxsize,
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                # requests sent while all the pooled connections were in use
+                "saturated_count": self.saturated_count,
+                "connections_created": connections_created,
+                "idle_connections": idle_connections,
+                "requests": requests_sent,
+            }
+
+
+# response decoding
+
+
+def json_loads(content):
+    # orjson if installed (nekobus[fast]), faster and with less temporary allocations
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def decode_response(response, *paths):
+    # decodes the whole raw response body, without the charset detection of response.json().
+    # With paths, returns only the values at these paths (None if missing). The rest of the
+    # decoded body can be garbage collected once the values are extracted.
+    data = json_loads(response.content)
+    if not paths:
+        return data
+    values = tuple(extract(data, path) for path in paths)
+    return values[0] if len(paths) == 1 else values
+
+
+def extract(data, path):
+    for key in path:
+        try:
+            data = data[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return data
+
+
+# cross-request cache
+
+
+class TTLCache:
+    # thread safe LRU cache with a TTL, for the facts that can be re-used across requests
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._values = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._values[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires < time.monotonic():
+                del self._values[key]
+                self.misses += 1
+                return default
+            self._values.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._values[key] = (time.monotonic() + self.ttl, value)
+            self._values.move_to_end(key)
+            while len(self._values) > self.maxsize:
+                self._values.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                return self._values.pop(key)[1]
+            except KeyError:
+                return default
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._values),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+            }
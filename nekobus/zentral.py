@@ -1,9 +1,14 @@
 import base64
-from datetime import datetime
+from datetime import datetime, timezone
 import logging
+import sys
+import threading
+import time
 import requests
 import urllib.parse
-from .utils import CustomHTTPAdapter
+from .metrics import timed_request
+from .throttling import BackendGovernor
+from .utils import CustomHTTPAdapter, TTLCache, decode_response, request_deadline
 from .version import __version__
 
 
@@ -23,34 +28,139 @@ class ZentralClientError(Exception):
     pass
 
 
+def get_dep_assignment_status(assignment, expected_profile_uuid):
+    if not assignment:
+        return "unknown"
+    profile_uuid, profile_status = assignment
+    if not profile_uuid:
+        return "missing_profile"
+    if profile_uuid != expected_profile_uuid:
+        return "wrong_profile"
+    if profile_status not in ("assigned", "pushed"):
+        return "wrong_profile_status"
+    return "OK"
+
+
+class EnrolledDeviceRecord:
+    # compact MDM enrolled device, for the whole-fleet indexes
+    __slots__ = ("created_at", "blocked", "checked_out", "cert_not_valid_after")
+
+    def __init__(self, created_at, blocked, checked_out, cert_not_valid_after):
+        self.created_at = created_at
+        self.blocked = blocked
+        self.checked_out = checked_out
+        # POSIX timestamp, None if unknown
+        self.cert_not_valid_after = cert_not_valid_after
+
+
+def build_enrolled_device_record(enrolled_device):
+    try:
+        cert_not_valid_after = datetime.fromisoformat(enrolled_device["cert_not_valid_after"])
+        if cert_not_valid_after.tzinfo is None:
+            cert_not_valid_after = cert_not_valid_after.replace(tzinfo=timezone.utc)
+        cert_not_valid_after = cert_not_valid_after.timestamp()
+    except Exception:
+        logger.exception("Could not parse MDM enrolled device %s cert validity. Default to invalid",
+                         enrolled_device.get("serial_number"))
+        cert_not_valid_after = None
+    return EnrolledDeviceRecord(
+        enrolled_device["created_at"],
+        bool(enrolled_device.get("blocked_at")),
+        bool(enrolled_device.get("checkout_at")),
+        cert_not_valid_after,
+    )
+
+
+def get_enrolled_device_record_status(record):
+    if not record:
+        return "not_found"
+    if record.blocked:
+        return "blocked"
+    if record.checked_out:
+        return "checked_out"
+    if record.cert_not_valid_after is None or record.cert_not_valid_after <= time.time():
+        return "invalid_cert"
+    return "enrolled"
+
+
+def get_enrolled_device_status(enrolled_device):
+    if not enrolled_device:
+        return "not_found"
+    return get_enrolled_device_record_status(build_enrolled_device_record(enrolled_device))
+
+
 class ZentralClient:
     default_timeout = 15  # 15 seconds
     max_retries = 3  # max 3 attempts
+    max_rate = 50  # max 50 requests / second
+    max_concurrency = 10  # max 10 in-flight requests
+    dep_assignment_cache_maxsize = 50000
+    dep_assignment_cache_ttl = 300  # 5 min
+    tags_cache_maxsize = 50000
+    tags_cache_ttl = 30  # 30 seconds, to cover the check → start → status sequence of a device
 
-    def __init__(self, base_url, token):
+    def __init__(self, base_url, token, max_concurrency=None, max_rate=None):
+        self.base_url = base_url
         self.api_base_url = f"{base_url}/api"
+        self.dep_device_index = None
+        self.mdm_enrolled_device_index = None
+        self.dep_assignment_cache = TTLCache(self.dep_assignment_cache_maxsize, self.dep_assignment_cache_ttl)
+        # the tags read by this process, dropped when set by this process
+        self.tags_cache = TTLCache(self.tags_cache_maxsize, self.tags_cache_ttl)
         self.session = requests.Session()
         self.session.headers.update(
             {'user-agent': f"nekobus/{__version__}",
              'accept': 'application/json',
              'authorization': f'Token {token}'}
         )
-        self.session.mount(
-            self.api_base_url,
-            CustomHTTPAdapter(self.default_timeout, self.max_retries)
-        )
+        if max_concurrency:
+            self.max_concurrency = max_concurrency
+        if max_rate:
+            self.max_rate = max_rate
+        self.governor = BackendGovernor('Zentral', self.max_rate, self.max_concurrency)
+        # mounted on the base URL to also cover the absolute pagination URLs
+        self.adapter = CustomHTTPAdapter(self.default_timeout, self.max_retries, self.governor)
+        self.session.mount(self.base_url, self.adapter)
+
+    def request(self, method, path, endpoint=None, url=None, **kwargs):
+        # endpoint: the metrics label, the path if None
+        if url is None:
+            url = f"{self.api_base_url}{path}"
+        return timed_request(self.session, "zentral", endpoint or path, method, url, **kwargs)
+
+    def open_connection(self):
+        # open a keep-alive connection to the API, the response doesn't matter
+        try:
+            self.request("HEAD", "/")
+        except requests.exceptions.RequestException:
+            logger.warning("Could not open connection to %s", self.api_base_url)
+
+    def iter_results(self, path, params=None):
+        url = None
+        while True:
+            try:
+                r = self.request("GET", path, url=url, params=params)
+                r.raise_for_status()
+            except Exception:
+                raise ZentralClientError(f"Could not get {path} page")
+            results, url = decode_response(r, ("results",), ("next",))
+            yield from results or []
+            # the next URL includes the query parameters
+            if not url:
+                break
+            params = None
 
     def get_dep_device(self, serial_number):
         logger.info("Get DEP device %s", serial_number)
         try:
-            r = self.session.get(f"{self.api_base_url}/mdm/dep/devices/", params={"serial_number": serial_number})
+            r = self.request("GET", "/mdm/dep/devices/", params={"serial_number": serial_number})
             r.raise_for_status()
         except Exception:
             raise ZentralClientError(f"Could not get DEP device {serial_number} info")
-        r_json = r.json()
-        if r_json.get("count") == 1:
+        count, dep_device = decode_response(r, ("count",), ("results", 0))
+        if count == 1:
             logger.info("DEP device %s found", serial_number)
-            return r_json["results"][0]
+            return dep_device
         else:
             logger.info("Unknown DEP device %s", serial_number)
             return None
@@ -58,90 +168,323 @@ class ZentralClient:
     def get_mdm_enrolled_device(self, serial_number):
         logger.info("Get MDM enrolled device %s", serial_number)
         try:
-            r = self.session.get(f"{self.api_base_url}/mdm/devices/", params={"serial_number": serial_number})
+            r = self.request("GET", "/mdm/devices/", params={"serial_number": serial_number})
             r.raise_for_status()
         except Exception:
             raise ZentralClientError(f"Could not search for MDM enrolled device {serial_number}")
-        r_json = r.json()
-        if "count" in r_json:
-            device_count = r_json["count"]
-            device_iter = r_json.get("results", [])
-        else:
-            # Older version of the API. TODO: remove.
-            device_count = len(r_json)
-            device_iter = r_json
-        logger.info("Found %d MDM enrolled device(s) %s", device_count, serial_number)
+        enrolled_devices = decode_response(r, ("results",)) or []
+        logger.info("Found %d MDM enrolled device(s) %s", len(enrolled_devices), serial_number)
         latest_enrolled_device = None
-        for enrolled_device in device_iter:
+        for enrolled_device in enrolled_devices:
             if latest_enrolled_device is None or enrolled_device["created_at"] > latest_enrolled_device["created_at"]:
                 latest_enrolled_device = enrolled_device
         return latest_enrolled_device
 
     def get_tags(self, serial_number):
+        tags = self.tags_cache.get(serial_number)
+        if tags is not None:
+            logger.info("Device %s cached tags", serial_number)
+            return tags
         logger.info("Get device %s tags", serial_number)
         url_safe_serial_number = make_url_safe_serial_number(serial_number)
         try:
-            r = self.session.get(f"{self.api_base_url}/inventory/machines/{url_safe_serial_number}/meta/")
+            r = self.request(
+                "GET", f"/inventory/machines/{url_safe_serial_number}/meta/",
+                endpoint="/inventory/machines/{serial_number}/meta/"
+            )
             if r.status_code == 404:
                 return None
             r.raise_for_status()
-            return r.json().get("tags", [])
+            tags = decode_response(r, ("tags",)) or []
         except Exception:
             raise ZentralClientError(f"Could not get device {serial_number} tags")
+        self.tags_cache.set(serial_number, tags)
+        return tags
 
-    def get_dep_status(self, serial_number, expected_profile_uuid):
-        logger.info("Check DEP device %s enrollment status", serial_number)
+    def get_dep_assignment(self, serial_number):
+        if self.dep_device_index is not None:
+            try:
+                assignment = self.dep_device_index.get(serial_number)
+            except ZentralClientError:
+                logger.exception("Could not refresh the DEP device index")
+            else:
+                if assignment is not None:
+                    return assignment
+                # not in the index if filtered, or if added since the last sync
         dep_device = self.get_dep_device(serial_number)
         if not dep_device:
-            return "unknown"
-        profile_uuid = dep_device.get("profile_uuid")
-        if not profile_uuid:
-            logger.warning("DEP device %s has no profile", serial_number)
-            return "missing_profile"
-        if profile_uuid != expected_profile_uuid:
-            logger.warning("Wrong profile UUID %s for DEP device %s", profile_uuid or "-", serial_number)
-            return "wrong_profile"
-        profile_status = dep_device.get("profile_status")
-        if profile_status not in ("assigned", "pushed"):
-            logger.warning("Wrong profile status %s for DEP device %s", profile_status or "-", serial_number)
-            return "wrong_profile_status"
-        return "OK"
+            return None
+        return dep_device.get("profile_uuid"), dep_device.get("profile_status")
+
+    def get_dep_status(self, serial_number, expected_profile_uuid):
+        logger.info("Check DEP device %s enrollment status", serial_number)
+        cache_key = (serial_number, expected_profile_uuid)
+        if self.dep_assignment_cache.get(cache_key) is not None:
+            logger.info("DEP device %s cached status: OK", serial_number)
+            return "OK"
+        assignment = self.get_dep_assignment(serial_number)
+        dep_status = get_dep_assignment_status(assignment, expected_profile_uuid)
+        if dep_status == "OK":
+            # only the OK assignments are cached, the other ones are fetched again until fixed
+            self.dep_assignment_cache.set(cache_key, assignment)
+        else:
+            logger.warning("DEP device %s status: %s", serial_number, dep_status)
+        return dep_status
 
     def get_mdm_status(self, serial_number):
         logger.info("Check MDM enrolled device %s status", serial_number)
-        enrolled_device = self.get_mdm_enrolled_device(serial_number)
-        if not enrolled_device:
-            logger.info("MDM enrolled device %s not found", serial_number)
-            return "not_found"
-        if enrolled_device.get("blocked_at"):
-            logger.warning("MDM enrolled device %s blocked", serial_number)
-            return "blocked"
-        if enrolled_device.get("checkout_at"):
-            logger.info("MDM enrolled device %s checked out", serial_number)
-            return "checked_out"
-        valid_cert = False
-        try:
-            valid_cert = datetime.fromisoformat(enrolled_device["cert_not_valid_after"]) > datetime.utcnow()
-        except Exception:
-            logger.exception("Could not verify MDM enrolled device %s cert validity. Default to False", serial_number)
-        if not valid_cert:
-            logger.info("MDM enrolled device %s has invalid cert", serial_number)
-            return "invalid_cert"
-        logger.info("MDM enrolled device %s has valid cert", serial_number)
-        return "enrolled"
+        mdm_status = None
+        if self.mdm_enrolled_device_index is not None:
+            try:
+                # not found until the next refresh, if enrolled since the last sync
+                mdm_status = self.mdm_enrolled_device_index.get_status(serial_number) or "not_found"
+            except ZentralClientError:
+                logger.exception("Could not refresh the MDM enrolled device index")
+        if mdm_status is None:
+            mdm_status = get_enrolled_device_status(self.get_mdm_enrolled_device(serial_number))
+        logger.info("MDM enrolled device %s status: %s", serial_number, mdm_status)
+        return mdm_status
 
-    def set_taxonomy_tags(self, serial_number, taxonomy, tags):
-        logger.info("Set device %s taxonomy %s tag(s) %s", serial_number, taxonomy, ", ".join(tags))
+    def iter_tagged_machines(self, tag, page_size=500):
+        return self.iter_results("/inventory/machines/", {"tag": tag, "limit": page_size})
+
+    def set_taxonomy_tags_many(self, serial_numbers, taxonomy, tags):
+        logger.info("Set %d device(s) taxonomy %s tag(s) %s", len(serial_numbers), taxonomy, ", ".join(tags))
         try:
-            r = self.session.post(
-                f"{self.api_base_url}/inventory/machines/tags/",
+            r = self.request(
+                "POST", "/inventory/machines/tags/",
                 json={
-                    "serial_numbers": [serial_number],
+                    "serial_numbers": list(serial_numbers),
                     "operations": [
-                        {"kind": "SET", "taxonomy": taxonomy, "names": tags}
+                        {"kind": "SET", "taxonomy": taxonomy, "names": list(tags)}
                     ]
                 }
             )
             r.raise_for_status()
         except Exception:
+            raise ZentralClientError(f"Could not set {len(serial_numbers)} device(s) tags")
+        finally:
+            # updated, or in an unknown state
+            for serial_number in serial_numbers:
+                self.tags_cache.pop(serial_number)
+
+    def set_taxonomy_tags(self, serial_number, taxonomy, tags):
+        logger.info("Set device %s taxonomy %s tag(s) %s", serial_number, taxonomy, ", ".join(tags))
+        try:
+            self.set_taxonomy_tags_many([serial_number], taxonomy, tags)
+        except ZentralClientError:
             raise ZentralClientError(f"Could not set device {serial_number} tags")
+
+
+class ZentralDeviceIndex:
+    # serial number → compact record snapshot of a paginated Zentral device list,
+    # refreshed once per TTL. If incremental_param is set, only the devices updated since
+    # the last sync are fetched, with a full sync every full_refresh_interval.
+    name = None
+    path = None
+    ttl = 600  # 10 min
+    page_size = 500
+    incremental_param = None
+    full_refresh_interval = 3600  # 1 hour
+
+    def __init__(self, client, ttl=None):
+        self.client = client
+        if ttl:
+            self.ttl = ttl
+        # protects the index state, never held while paging the API
+        self._lock = threading.Lock()
+        # single-flight refresh
+        self._refresh_lock = threading.Lock()
+        self._index = None
+        self._synced_at = None
+        self._full_synced_at = None
+        self._cursor = None
+
+    def get_filters(self):
+        return {}
+
+    def update_index(self, index, item):
+        raise NotImplementedError
+
+    def _is_fresh(self, now):
+        return self._index is not None and now - self._synced_at < self.ttl
+
+    def refresh(self, force=False):
+        with self._lock:
+            if not force and self._is_fresh(time.monotonic()):
+                return
+            initialized = self._index is not None
+        # the other threads keep using the current index during the refresh
+        if not self._refresh_lock.acquire(blocking=force or not initialized):
+            return
+        # shared work, not bound by the deadline of the request triggering it
+        try:
+            with request_deadline(None):
+                self._refresh(force)
+        finally:
+            self._refresh_lock.release()
+
+    def _refresh(self, force):
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._is_fresh(now):
+                # refreshed by another thread
+                return
+            incremental = (
+                not force
+                and self._index is not None
+                and self.incremental_param is not None
+                and self._cursor is not None
+                and now - self._full_synced_at < self.full_refresh_interval
+            )
+            cursor = self._cursor if incremental else None
+        params = self.get_filters()
+        params["limit"] = self.page_size
+        if incremental:
+            logger.info("Refresh %s index since %s", self.name, cursor)
+            params[self.incremental_param] = cursor
+        else:
+            logger.info("Refresh %s index", self.name)
+        index = {}
+        for item in self.client.iter_results(self.path, params):
+            self.update_index(index, item)
+            updated_at = item.get("updated_at")
+            if updated_at and (cursor is None or updated_at > cursor):
+                cursor = updated_at
+        with self._lock:
+            if incremental:
+                for serial_number, value in index.items():
+                    self.merge_index(self._index, serial_number, value)
+            else:
+                self._index = index
+                self._full_synced_at = now
+            self._cursor = cursor
+            self._synced_at = now
+            logger.info("%s index refreshed. %d device(s)", self.name, len(self._index))
+
+    def merge_index(self, index, serial_number, value):
+        index[serial_number] = value
+
+    def get(self, serial_number):
+        self.refresh()
+        with self._lock:
+            return self._index.get(serial_number)
+
+
+class DEPDeviceIndex(ZentralDeviceIndex):
+    # serial number → (profile UUID, profile status)
+    name = "DEP device"
+    path = "/mdm/dep/devices/"
+
+    def __init__(self, client, profile_uuid=None, ttl=None):
+        super().__init__(client, ttl)
+        self.profile_uuid = profile_uuid
+
+    def get_filters(self):
+        filters = {}
+        if self.profile_uuid:
+            filters["profile_uuid"] = self.profile_uuid
+        return filters
+
+    def refresh(self, force=False):
+        synced_at = self._synced_at
+        super().refresh(force)
+        if self._synced_at != synced_at:
+            # the cached assignments could be older than the new index
+            self.client.dep_assignment_cache.clear()
+
+    def update_index(self, index, dep_device):
+        profile_uuid = dep_device.get("profile_uuid")
+        if profile_uuid:
+            profile_uuid = sys.intern(profile_uuid)
+        profile_status = dep_device.get("profile_status")
+        if profile_status:
+            profile_status = sys.intern(profile_status)
+        index[dep_device["serial_number"]] = (profile_uuid, profile_status)
+
+
+class MDMEnrolledDeviceIndex(ZentralDeviceIndex):
+    # serial number → latest EnrolledDeviceRecord
+    name = "MDM enrolled device"
+    path = "/mdm/devices/"
+    ttl = 60  # 1 min
+    incremental_param = "updated_since"
+
+    def update_index(self, index, enrolled_device):
+        self.merge_index(index, enrolled_device["serial_number"], build_enrolled_device_record(enrolled_device))
+
+    def merge_index(self, index, serial_number, record):
+        current_record = index.get(serial_number)
+        if current_record is None or record.created_at >= current_record.created_at:
+            index[serial_number] = record
+
+    def get_status(self, serial_number):
+        # None if the device is not in the index
+        record = self.get(serial_number)
+        if record is None:
+            return None
+        return get_enrolled_device_record_status(record)
+
+
+class ZentralTagBatcher:
+    # write-behind buffer for the SET tag operations.
+    # The operations are grouped by (taxonomy, tags), and each group is sent as one request.
+    # A group is sent when it reaches max_batch_size, all groups are sent when the oldest
+    # pending operation is older than max_delay. The thresholds are only evaluated when
+    # a new operation is added. flush() must be called to send the remaining operations.
+    max_batch_size = 500
+    max_delay = 10  # 10 seconds
+
+    def __init__(self, client, max_batch_size=None, max_delay=None):
+        self.client = client
+        if max_batch_size:
+            self.max_batch_size = max_batch_size
+        if max_delay is not None:
+            self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._groups = {}
+        self._oldest = None
+        self.failed_serial_numbers = set()
+
+    def set_taxonomy_tags(self, serial_number, taxonomy, tags):
+        logger.info("Queue device %s taxonomy %s tag(s) %s", serial_number, taxonomy, ", ".join(tags))
+        key = (taxonomy, tuple(tags))
+        with self._lock:
+            # SET replaces all the taxonomy tags, only the last operation matters
+            for (group_taxonomy, _), serial_numbers in self._groups.items():
+                if group_taxonomy == taxonomy:
+                    serial_numbers.pop(serial_number, None)
+            serial_numbers = self._groups.setdefault(key, {})
+            serial_numbers[serial_number] = None
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if time.monotonic() - self._oldest >= self.max_delay:
+                groups = self._pop_groups()
+            elif len(serial_numbers) >= self.max_batch_size:
+                groups = {key: self._groups.pop(key)}
+            else:
+                groups = None
+        if groups:
+            self._send(groups)
+
+    def _pop_groups(self):
+        groups = self._groups
+        self._groups = {}
+        self._oldest = None
+        return groups
+
+    def _send(self, groups):
+        for (taxonomy, tags), serial_numbers in groups.items():
+            if not serial_numbers:
+                continue
+            try:
+                self.client.set_taxonomy_tags_many(list(serial_numbers), taxonomy, tags)
+            except ZentralClientError:
+                logger.exception("Could not set taxonomy %s tag(s) %s", taxonomy, ", ".join(tags))
+                with self._lock:
+                    self.failed_serial_numbers.update(serial_numbers)
+
+    def flush(self):
+        with self._lock:
+            groups = self._pop_groups()
+        self._send(groups)
@@ -0,0 +1,49 @@
+import os
+import sys
+import pytest
+
+# the local Jamf and Zentral stand-ins of the benchmarks
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from fakes import FakeFleet, FakeJamfHandler, FakeServer, FakeZentralHandler  # noqa: E402
+from nekobus.migration import MigrationManager  # noqa: E402
+
+
+PROFILE_UUID = "c3a5b6f4-0000-4000-8000-000000000000"
+TAXONOMY = "Migration"
+
+
+@pytest.fixture
+def fleet():
+    return FakeFleet(20, PROFILE_UUID, TAXONOMY, "ready")
+
+
+@pytest.fixture
+def jamf_server(fleet):
+    server = FakeServer(FakeJamfHandler, fleet).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def zentral_server(fleet):
+    server = FakeServer(FakeZentralHandler, fleet).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def make_migration_manager(jamf_server, zentral_server):
+    def make(**kwargs):
+        return MigrationManager(
+            jamf_server.base_url, "client_id", "client_secret",
+            zentral_server.base_url, "zentral_token",
+            PROFILE_UUID, TAXONOMY, "ready", "started", "unenrolled", "finished",
+            **kwargs
+        )
+    return make
+
+
+@pytest.fixture
+def migration_manager(make_migration_manager):
+    return make_migration_manager()
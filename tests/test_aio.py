@@ -0,0 +1,68 @@
+import asyncio
+import time
+from nekobus.aio import AsyncMigrationManager
+
+
+def test_async_migration_manager(migration_manager, fleet):
+    amm = AsyncMigrationManager(migration_manager, max_concurrency=5)
+    serial_numbers = fleet.serial_numbers[:6]
+
+    async def run():
+        check_result = await amm.check(serial_numbers[0])
+        check_results = await amm.check_many(serial_numbers)
+        start_results = await amm.start_many(serial_numbers[:3])
+        finish_results = await amm.finish_many(serial_numbers[3:])
+        return check_result, check_results, start_results, finish_results
+
+    try:
+        check_result, check_results, start_results, finish_results = asyncio.run(run())
+    finally:
+        amm.close()
+    assert check_result["check"] is True
+    assert [r["check"] for r in check_results] == [True] * 6
+    for result in start_results + finish_results:
+        assert "error" not in result
+    assert all(fleet.tags[sn] == ["started"] for sn in serial_numbers[:3])
+    assert all(not fleet.mdm_capable[sn] for sn in serial_numbers[:3])
+    assert all(fleet.tags[sn] == ["finished"] for sn in serial_numbers[3:])
+
+
+def slow_lookups(mm, monkeypatch, delay=0.3):
+    # records the (start, end) of each lookup
+    intervals = {}
+    zentral_client = mm.zentral_client
+    for name in ("get_tags", "get_dep_status"):
+        method = getattr(zentral_client, name)
+
+        def slow_method(*args, name=name, method=method):
+            start = time.monotonic()
+            time.sleep(delay)
+            try:
+                return method(*args)
+            finally:
+                intervals[name] = (start, time.monotonic())
+
+        monkeypatch.setattr(zentral_client, name, slow_method)
+    return intervals
+
+
+def assert_overlap(intervals):
+    (tags_start, tags_end), (dep_start, dep_end) = intervals["get_tags"], intervals["get_dep_status"]
+    assert tags_start < dep_end and dep_start < tags_end
+
+
+def test_async_check_concurrent_lookups(migration_manager, fleet, monkeypatch):
+    intervals = slow_lookups(migration_manager, monkeypatch)
+    amm = AsyncMigrationManager(migration_manager)
+    try:
+        result = asyncio.run(amm.check(fleet.serial_numbers[0]))
+    finally:
+        amm.close()
+    assert result["check"] is True
+    assert_overlap(intervals)
+
+
+def test_check_concurrent_lookups(migration_manager, fleet, monkeypatch):
+    intervals = slow_lookups(migration_manager, monkeypatch)
+    assert migration_manager.check(fleet.serial_numbers[0])["check"] is True
+    assert_overlap(intervals)
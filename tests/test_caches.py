@@ -0,0 +1,79 @@
+import time
+from nekobus.utils import TTLCache
+from .conftest import PROFILE_UUID
+
+
+def test_ttl_cache():
+    cache = TTLCache(2, 60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    # LRU eviction
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.pop("c") == 3
+    assert cache.get("c", "default") == "default"
+    stats = cache.stats()
+    assert stats["hits"] == 3
+    assert stats["misses"] == 2
+    assert stats["size"] == 1
+    cache.clear()
+    assert cache.stats()["size"] == 0
+
+
+def test_ttl_cache_expiry():
+    cache = TTLCache(10, 0.05)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    time.sleep(0.1)
+    assert cache.get("a") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_dep_assignment_cache_only_ok(migration_manager, fleet, zentral_server):
+    zentral_client = migration_manager.zentral_client
+    serial_number = fleet.serial_numbers[0]
+    wrong_profile_uuid = "00000000-0000-4000-8000-000000000000"
+    assert zentral_client.get_dep_status(serial_number, wrong_profile_uuid) == "wrong_profile"
+    assert zentral_client.get_dep_status(serial_number, wrong_profile_uuid) == "wrong_profile"
+    assert zentral_server.counts["GET dep_devices"] == 2
+    assert zentral_client.get_dep_status(serial_number, PROFILE_UUID) == "OK"
+    assert zentral_client.get_dep_status(serial_number, PROFILE_UUID) == "OK"
+    assert zentral_server.counts["GET dep_devices"] == 3
+    # the cached OK status is not re-used for another profile
+    assert zentral_client.get_dep_status(serial_number, wrong_profile_uuid) == "wrong_profile"
+    assert zentral_server.counts["GET dep_devices"] == 4
+
+
+def test_dep_assignment_cache_cleared_by_index_refresh(make_migration_manager, fleet):
+    mm = make_migration_manager(dep_device_index_ttl=600)
+    zentral_client = mm.zentral_client
+    serial_number = fleet.serial_numbers[0]
+    assert zentral_client.get_dep_status(serial_number, PROFILE_UUID) == "OK"
+    assert zentral_client.dep_assignment_cache.stats()["size"] == 1
+    # not refreshed, TTL
+    zentral_client.dep_device_index.refresh()
+    assert zentral_client.dep_assignment_cache.stats()["size"] == 1
+    zentral_client.dep_device_index.refresh(force=True)
+    assert zentral_client.dep_assignment_cache.stats()["size"] == 0
+
+
+def test_check_start_status_reads(make_migration_manager, fleet, zentral_server):
+    mm = make_migration_manager(jamf_webhooks=True)
+    serial_number = fleet.serial_numbers[0]
+    assert mm.check(serial_number)["check"]
+    mm.start(serial_number)
+    assert zentral_server.counts["GET machine_meta"] == 1
+    assert zentral_server.counts["GET dep_devices"] == 1
+    # the started tag write drops the cached tags
+    assert mm.status(serial_number)["jamf_status"] == "unenrolled"
+    assert fleet.tags[serial_number] == ["unenrolled"]
+    assert zentral_server.counts["GET machine_meta"] == 2
+    assert zentral_server.counts["GET dep_devices"] == 1
+    assert zentral_server.counts["GET mdm_devices"] == 1
+    # unknown devices are not cached
+    assert mm.zentral_client.get_tags("UNKNOWN0001") is None
+    assert mm.zentral_client.get_tags("UNKNOWN0001") is None
+    assert zentral_server.counts["GET machine_meta"] == 4
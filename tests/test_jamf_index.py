@@ -0,0 +1,70 @@
+import threading
+
+
+def expire(index):
+    index._synced_at -= index.ttl
+
+
+def test_unmanaged_device_status(make_migration_manager, fleet, jamf_server):
+    mm = make_migration_manager(jamf_computer_index_ttl=60)
+    serial_number = fleet.serial_numbers[0]
+    assert mm.jamf_client.get_mdm_status(serial_number) == "enrolled"
+    assert jamf_server.counts["GET computers_inventory"] == 1
+    results = mm.start_many([serial_number])
+    assert "error" not in results[0]
+    # lastContactTime unchanged, the indexed record is invalidated
+    assert mm.jamf_client.get_mdm_status(serial_number) == "unenrolled"
+    assert jamf_server.counts["GET computer"] == 1
+    # the started device is re-fetched during the incremental sync
+    expire(mm.jamf_client.computer_index)
+    assert mm.jamf_client.get_mdm_status(serial_number) == "unenrolled"
+    assert jamf_server.counts["GET computers_inventory"] == 3
+    assert jamf_server.counts["GET computer"] == 1
+    assert mm.jamf_client.computer_index._index[serial_number].mdm_capable is False
+
+
+def test_tracked_device_without_contact(make_migration_manager, fleet):
+    mm = make_migration_manager(jamf_computer_index_ttl=60)
+    tracked_serial_number, other_serial_number = fleet.serial_numbers[:2]
+    for serial_number in (tracked_serial_number, other_serial_number):
+        # older than the sync cursor
+        fleet.last_contact_times[serial_number] = "2023-01-01T00:00:00.000Z"
+    mm.track_started_devices(tracked_serial_number)
+    mm.jamf_client.computer_index.refresh()
+    fleet.mdm_capable[tracked_serial_number] = False
+    fleet.mdm_capable[other_serial_number] = False
+    expire(mm.jamf_client.computer_index)
+    assert mm.jamf_client.get_mdm_status(tracked_serial_number) == "unenrolled"
+    # not tracked and no contact, synced with the next full refresh
+    assert mm.jamf_client.get_mdm_status(other_serial_number) == "enrolled"
+    mm.jamf_client.computer_index.refresh(force=True)
+    assert mm.jamf_client.get_mdm_status(other_serial_number) == "unenrolled"
+
+
+def test_index_readable_during_refresh(make_migration_manager, fleet):
+    mm = make_migration_manager(jamf_computer_index_ttl=60)
+    index = mm.jamf_client.computer_index
+    serial_number = fleet.serial_numbers[0]
+    index.refresh()
+    paging = threading.Event()
+    release = threading.Event()
+    iter_computers = index.iter_computers
+
+    def blocking_iter_computers(rsql_filter=None):
+        paging.set()
+        release.wait(5)
+        yield from iter_computers(rsql_filter)
+
+    index.iter_computers = blocking_iter_computers
+    refresh_thread = threading.Thread(target=index.refresh, kwargs={"force": True})
+    refresh_thread.start()
+    assert paging.wait(5)
+    expire(index)
+    # current index, no wait for the refresh
+    assert index.get(serial_number).mdm_capable is True
+    index.track(serial_number)
+    index.invalidate(serial_number)
+    release.set()
+    refresh_thread.join()
+    # invalidated during the refresh
+    assert index.get(serial_number) is None
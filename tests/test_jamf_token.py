@@ -0,0 +1,74 @@
+import threading
+import time
+from nekobus.jamf import JamfTokenManager
+
+
+class FakeClient:
+    base_url = "https://jamf.example.com"
+    client_id = "yolo"
+
+
+class FakeTokenManager(JamfTokenManager):
+    def __init__(self, *args, expires_in=1200, fetch_delay=0, **kwargs):
+        super().__init__(FakeClient(), *args, **kwargs)
+        self.expires_in = expires_in
+        self.fetch_delay = fetch_delay
+        self.fetch_count = 0
+
+    def _fetch(self):
+        time.sleep(self.fetch_delay)
+        self.fetch_count += 1
+        return f"token{self.fetch_count}", time.time() + self.expires_in
+
+
+def test_single_flight_refresh():
+    manager = FakeTokenManager(fetch_delay=0.1)
+    tokens = []
+    threads = [threading.Thread(target=lambda: tokens.append(manager.get_token())) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert tokens == ["token1"] * 10
+    assert manager.fetch_count == 1
+    # rejected token
+    assert manager.get_token(rejected_token="token1") == "token2"
+    # stale rejected token
+    assert manager.get_token(rejected_token="token1") == "token2"
+    assert manager.fetch_count == 2
+
+
+def test_valid_token_not_blocked_by_refresh():
+    manager = FakeTokenManager(fetch_delay=0.5)
+    manager.get_token()
+    thread = threading.Thread(target=manager.get_token, kwargs={"force": True})
+    thread.start()
+    time.sleep(0.1)
+    start = time.monotonic()
+    assert manager.get_token() == "token1"
+    assert time.monotonic() - start < 0.1
+    thread.join()
+    assert manager.get_token() == "token2"
+
+
+def test_background_refresh_ignores_cached_token_in_refresh_window(tmp_path):
+    cache_path = str(tmp_path / "token.json")
+    manager = FakeTokenManager(cache_path)
+    # cached token, valid but inside the background refresh window
+    expires_at = time.time() + manager.min_validity_seconds + manager.background_refresh_margin / 2
+    manager._write_cache("cached", expires_at)
+    assert manager.get_token() == "cached"
+    assert manager._get_background_refresh_delay() == manager.background_min_sleep
+    manager._background_refresh()
+    assert manager.fetch_count == 1
+    assert manager.get_token() == "token1"
+    # the next refresh is scheduled before the new token enters the refresh window
+    delay = manager._get_background_refresh_delay()
+    assert 1200 - manager.min_validity_seconds - manager.background_refresh_margin - 5 < delay
+    # no refresh outside the window
+    manager._background_refresh()
+    assert manager.fetch_count == 1
+    # another process read the new token from the cache
+    other_manager = FakeTokenManager(cache_path)
+    assert other_manager.get_token() == "token1"
+    assert other_manager.fetch_count == 0
@@ -0,0 +1,59 @@
+from datetime import timedelta
+from nekobus.jobs import Job, SQLiteJobStore
+
+
+def test_enqueue_idempotency(tmp_path):
+    job_store = SQLiteJobStore(str(tmp_path / "jobs.db"))
+    job, created = job_store.enqueue("SERIAL1", "key1")
+    assert created
+    assert job.status == Job.QUEUED
+    assert job.created_at.utcoffset() == timedelta(0)
+    same_job, created = job_store.enqueue("SERIAL1", "key1")
+    assert not created
+    assert same_job.created_at == job.created_at
+    _, created = job_store.enqueue("SERIAL1", "key2")
+    assert created
+    assert job_store.get("SERIAL1", "key1").idempotency_key == "key1"
+    assert job_store.get("SERIAL2", "key1") is None
+
+
+def test_claim_and_complete(tmp_path):
+    job_store = SQLiteJobStore(str(tmp_path / "jobs.db"))
+    for i in range(3):
+        job_store.enqueue(f"SERIAL{i}", "key")
+    jobs = job_store.claim(2)
+    assert [job.serial_number for job in jobs] == ["SERIAL0", "SERIAL1"]
+    assert all(job.status == Job.RUNNING for job in jobs)
+    # running jobs are not claimed again before the end of the lease
+    assert [job.serial_number for job in job_store.claim(10)] == ["SERIAL2"]
+    assert job_store.claim(10) == []
+    job_store.complete(jobs[0])
+    job_store.complete(jobs[1], "Device not ready for migration")
+    assert job_store.get("SERIAL0", "key").status == Job.DONE
+    job = job_store.get("SERIAL1", "key")
+    assert job.status == Job.FAILED
+    assert job.serialize()["error"] == "Device not ready for migration"
+
+
+def test_claim_expired_lease(tmp_path):
+    job_store = SQLiteJobStore(str(tmp_path / "jobs.db"))
+    job_store.enqueue("SERIAL0", "key")
+    assert len(job_store.claim(10)) == 1
+    job_store.lease_seconds = -1
+    assert len(job_store.claim(10)) == 1
+
+
+def test_queue_and_run_start_jobs(tmp_path, migration_manager, fleet):
+    job_store = SQLiteJobStore(str(tmp_path / "jobs.db"))
+    serial_numbers = fleet.serial_numbers[:5]
+    for serial_number in serial_numbers:
+        job = migration_manager.queue_start(serial_number, "key", job_store)
+        assert job.status == Job.QUEUED
+    # retried request, same job
+    assert migration_manager.queue_start(serial_numbers[0], "key", job_store).status == Job.QUEUED
+    assert migration_manager.run_start_jobs(job_store, batch_size=2, max_jobs=3) == 3
+    assert migration_manager.run_start_jobs(job_store, timeout=60) == 2
+    assert migration_manager.run_start_jobs(job_store) == 0
+    for serial_number in serial_numbers:
+        assert job_store.get(serial_number, "key").status == Job.DONE
+        assert fleet.tags[serial_number] == ["started"]
@@ -0,0 +1,45 @@
+import io
+import json
+from nekobus.metrics import EMFMetricsSink, MetricsCollector
+
+
+def read_records(stream):
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_emf_records_max_values():
+    collector = MetricsCollector()
+    for i in range(250):
+        collector.record_call("jamf", "computer", "GET", 200 if i % 2 else 429, 0, 10, 0.01)
+    collector.record_span("check", 0.5, False)
+    stream = io.StringIO()
+    EMFMetricsSink(stream=stream).emit(collector)
+    records = read_records(stream)
+    call_records = [r for r in records if "Endpoint" in r]
+    assert [len(r["Duration"]) for r in call_records] == [100, 100, 50]
+    for record in call_records:
+        for name in ("Duration", "Bytes", "Retries", "Errors", "StatusCodes"):
+            assert len(record[name]) == len(record["Duration"])
+    assert sum(sum(r["Errors"]) for r in call_records) == 125
+    span_records = [r for r in records if "Operation" in r]
+    assert len(span_records) == 1
+    assert span_records[0]["Duration"] == [500.0]
+
+
+def test_emf_throttling_increments():
+    stream = io.StringIO()
+    sink = EMFMetricsSink(stream=stream)
+    metrics = {"rate": 25, "max_rate": 50, "concurrency_limit": 5, "max_concurrency": 10,
+               "in_flight": 2, "throttled_count": 3, "decrease_count": 1}
+    sink.emit_throttling({"jamf": metrics})
+    sink.emit_throttling({"jamf": dict(metrics, throttled_count=7, decrease_count=2)})
+    first, second = read_records(stream)
+    assert first["Backend"] == "jamf"
+    assert first["Rate"] == 25
+    assert first["ConcurrencyLimit"] == 5
+    assert first["Throttled"] == 3
+    assert second["Throttled"] == 4
+    assert second["Decreases"] == 1
+    assert {m["Name"] for m in second["_aws"]["CloudWatchMetrics"][0]["Metrics"]} == {
+        "Rate", "ConcurrencyLimit", "InFlight", "Throttled", "Decreases"
+    }
@@ -0,0 +1,70 @@
+import io
+import json
+from nekobus import cli, report
+from .conftest import PROFILE_UUID, TAXONOMY
+
+
+def set_zentral_environ(monkeypatch, zentral_server):
+    for k in ("NEKOBUS_JAMF_BASE_URL", "NEKOBUS_JAMF_CLIENT_ID", "NEKOBUS_JAMF_CLIENT_SECRET"):
+        monkeypatch.delenv(k, raising=False)
+    for k, v in (("NEKOBUS_ZENTRAL_BASE_URL", zentral_server.base_url),
+                 ("NEKOBUS_ZENTRAL_TOKEN", "zentral_token"),
+                 ("NEKOBUS_PROFILE_UUID", PROFILE_UUID),
+                 ("NEKOBUS_TAXONOMY", TAXONOMY),
+                 ("NEKOBUS_READY_TAG", "ready"),
+                 ("NEKOBUS_STARTED_TAG", "started"),
+                 ("NEKOBUS_UNENROLLED_TAG", "unenrolled"),
+                 ("NEKOBUS_FINISHED_TAG", "finished")):
+        monkeypatch.setenv(k, v)
+
+
+def test_report_without_jamf_settings(monkeypatch, capsys, fleet, zentral_server):
+    set_zentral_environ(monkeypatch, zentral_server)
+    fleet.tags[fleet.serial_numbers[0]] = ["finished"]
+    cli.main(["report"])
+    out, err = capsys.readouterr()
+    rows = [json.loads(line) for line in out.splitlines()]
+    assert len(rows) == len(fleet.serial_numbers)
+    assert {row["serial_number"]: row["state"] for row in rows}[fleet.serial_numbers[0]] == "finished"
+    counts = json.loads(err.splitlines()[-1])
+    assert counts["ready"] == len(fleet.serial_numbers) - 1
+    assert counts["finished"] == 1
+
+
+def test_report_csv(monkeypatch, capsys, fleet, zentral_server):
+    set_zentral_environ(monkeypatch, zentral_server)
+    cli.main(["report", "--format", "csv"])
+    out, _ = capsys.readouterr()
+    lines = out.splitlines()
+    assert lines[0] == ",".join(report.MigrationReport.fields)
+    assert len(lines) == len(fleet.serial_numbers) + 1
+
+
+def test_report_write(migration_manager, fleet):
+    stream = io.StringIO()
+    counts = report.MigrationReport(migration_manager).write(stream)
+    assert counts["ready"] == len(fleet.serial_numbers)
+
+
+def test_report_wrong_profile(make_migration_manager, fleet):
+    serial_number = fleet.serial_numbers[0]
+    fleet.dep_profile_uuids[serial_number] = "00000000-0000-4000-8000-000000000000"
+    mm = make_migration_manager(dep_device_index_ttl=60)
+    rows = {row["serial_number"]: row for row in report.MigrationReport(mm).iter_rows()}
+    assert rows[serial_number]["dep_status"] == "wrong_profile"
+    assert rows[serial_number]["state"] == "stuck"
+    assert rows[fleet.serial_numbers[1]]["dep_status"] == "OK"
+
+
+def test_max_rates(monkeypatch, zentral_server):
+    set_zentral_environ(monkeypatch, zentral_server)
+    mm = cli.get_migration_manager(with_jamf=False)
+    assert mm.jamf_client.governor.max_rate == 50
+    assert mm.zentral_client.governor.max_rate == 50
+    monkeypatch.setenv("NEKOBUS_JAMF_MAX_RATE", "20")
+    monkeypatch.setenv("NEKOBUS_ZENTRAL_MAX_RATE", "100")
+    mm = cli.get_migration_manager(with_jamf=False)
+    assert mm.jamf_client.governor.max_rate == 20
+    assert mm.zentral_client.governor.max_rate == 100
+    mm = cli.get_migration_manager(with_jamf=False, zentral_max_rate=10)
+    assert mm.zentral_client.governor.max_rate == 10
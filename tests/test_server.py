@@ -0,0 +1,79 @@
+import base64
+import http.client
+import json
+import os
+import sys
+import threading
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lambda"))
+
+from server import Server  # noqa: E402
+
+
+def echo_handler(event, context):
+    body = event["body"]
+    if body and event["isBase64Encoded"]:
+        body = base64.b64decode(body).decode("utf-8")
+    return {"statusCode": 200, "headers": {"Content-Type": "application/json"}, "body": json.dumps({"body": body})}
+
+
+@pytest.fixture
+def server():
+    server = Server(("127.0.0.1", 0), echo_handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post(server, body, headers):
+    conn = http.client.HTTPConnection(*server.server_address, timeout=5)
+    conn.putrequest("POST", "/?operation=check_many", skip_accept_encoding=True)
+    for k, v in headers.items():
+        conn.putheader(k, v)
+    conn.endheaders()
+    if body:
+        conn.send(body)
+    response = conn.getresponse()
+    return conn, response.status, json.loads(response.read())
+
+
+def test_content_length_body(server):
+    body = b'{"serial_numbers": ["A"]}'
+    conn, status, data = post(server, body, {"Content-Length": str(len(body))})
+    assert status == 200
+    assert data == {"body": body.decode("utf-8")}
+    # keep-alive
+    conn.request("GET", "/?operation=check")
+    response = conn.getresponse()
+    assert response.status == 200
+    assert json.loads(response.read()) == {"body": None}
+
+
+def test_chunked_body(server):
+    body = b'5\r\n{"ser\r\n14;ext=1\r\nial_numbers": ["A"]}\r\n0\r\nX-Trailer: 1\r\n\r\n'
+    conn, status, data = post(server, body, {"Transfer-Encoding": "chunked"})
+    assert status == 200
+    assert data == {"body": '{"serial_numbers": ["A"]}'}
+    # keep-alive, the whole chunked body was read
+    conn.request("GET", "/?operation=check")
+    response = conn.getresponse()
+    assert response.status == 200
+    assert json.loads(response.read()) == {"body": None}
+
+
+def test_length_required(server):
+    _, status, data = post(server, None, {})
+    assert status == 411
+    assert data["error"] == "Length required"
+
+
+def test_payload_too_large(server, monkeypatch):
+    from server import RequestHandler
+    monkeypatch.setattr(RequestHandler, "max_body_size", 10)
+    _, status, _ = post(server, b"x" * 11, {"Content-Length": "11"})
+    assert status == 413
+    _, status, _ = post(server, b"b\r\nxxxxxxxxxxx\r\n0\r\n\r\n", {"Transfer-Encoding": "chunked"})
+    assert status == 413
@@ -0,0 +1,106 @@
+import pytest
+from nekobus.jamf import JamfClientError
+from nekobus.migration import MigrationError
+
+
+def test_start_many(migration_manager, fleet, jamf_server):
+    serial_numbers = fleet.serial_numbers[:15]
+    fleet.tags[serial_numbers[0]] = ["started"]
+    results = migration_manager.start_many(serial_numbers + ["UNKNOWN0001"])
+    results = {result["serial_number"]: result for result in results}
+    assert results[serial_numbers[0]]["status_code"] == 400
+    assert results["UNKNOWN0001"]["status_code"] == 404
+    for serial_number in serial_numbers[1:]:
+        assert "error" not in results[serial_number]
+        assert fleet.tags[serial_number] == ["started"]
+        assert not fleet.mdm_capable[serial_number]
+    assert fleet.mdm_capable[serial_numbers[0]]
+    # one bulk ID lookup and one command
+    assert jamf_server.counts["GET computers_basic"] == 1
+    assert jamf_server.counts["POST unmanage"] == 1
+    assert jamf_server.counts["GET computer"] == 0
+
+
+def test_get_computer_device_ids(migration_manager, fleet, jamf_server):
+    jamf_client = migration_manager.jamf_client
+    # few serial numbers, looked up individually
+    serial_numbers = fleet.serial_numbers[:3]
+    assert jamf_client.get_computer_device_ids(serial_numbers) == {
+        serial_number: fleet.jamf_ids[serial_number] for serial_number in serial_numbers
+    }
+    assert jamf_server.counts["GET computer"] == 3
+    assert jamf_server.counts["GET computers_basic"] == 0
+    # many serial numbers, one listing
+    serial_numbers = fleet.serial_numbers[3:15]
+    assert len(jamf_client.get_computer_device_ids(serial_numbers)) == 12
+    assert jamf_server.counts["GET computers_basic"] == 1
+    # the IDs of the whole listing are cached
+    serial_numbers = fleet.serial_numbers[15:]
+    assert jamf_client.get_computer_device_ids(serial_numbers) == {
+        serial_number: fleet.jamf_ids[serial_number] for serial_number in serial_numbers
+    }
+    assert jamf_server.counts["GET computers_basic"] == 1
+    assert jamf_server.counts["GET computer"] == 3
+
+
+def test_start_many_unmanage_failures(migration_manager, fleet, monkeypatch):
+    serial_numbers = fleet.serial_numbers[:5]
+    failed_serial_number = serial_numbers[2]
+    failed_jamf_id = fleet.jamf_ids[failed_serial_number]
+    missing_serial_number = serial_numbers[3]
+    jamf_client = migration_manager.jamf_client
+    get_computer_device_ids = jamf_client.get_computer_device_ids
+    queue_unmanage_command = jamf_client._queue_unmanage_command
+
+    def missing_get_computer_device_ids(serial_numbers):
+        # not found in Jamf
+        jamf_ids = get_computer_device_ids(serial_numbers)
+        jamf_ids.pop(missing_serial_number)
+        return jamf_ids
+
+    def failing_queue_unmanage_command(jamf_ids):
+        if failed_jamf_id in jamf_ids:
+            raise JamfClientError("yolo")
+        queue_unmanage_command(jamf_ids)
+
+    monkeypatch.setattr(jamf_client, "get_computer_device_ids", missing_get_computer_device_ids)
+    monkeypatch.setattr(jamf_client, "_queue_unmanage_command", failing_queue_unmanage_command)
+    results = {result["serial_number"]: result for result in migration_manager.start_many(serial_numbers)}
+    for serial_number in (failed_serial_number, missing_serial_number):
+        assert results[serial_number]["status_code"] == 500
+        assert fleet.tags[serial_number] == ["ready"]
+    for serial_number in set(serial_numbers) - {failed_serial_number, missing_serial_number}:
+        assert "error" not in results[serial_number]
+        assert fleet.tags[serial_number] == ["started"]
+        assert not fleet.mdm_capable[serial_number]
+
+
+def test_unmanage_computer_devices_batches(migration_manager, fleet, jamf_server):
+    serial_numbers = fleet.serial_numbers[:10]
+    results = migration_manager.jamf_client.unmanage_computer_devices(serial_numbers, batch_size=3)
+    assert results == dict.fromkeys(serial_numbers, True)
+    assert jamf_server.counts["POST unmanage"] == 4
+
+
+def test_start_unmanage_failure(migration_manager, fleet, monkeypatch):
+    serial_number = fleet.serial_numbers[0]
+
+    def failing_queue_unmanage_command(jamf_ids):
+        raise JamfClientError("yolo")
+
+    monkeypatch.setattr(migration_manager.jamf_client, "_queue_unmanage_command", failing_queue_unmanage_command)
+    with pytest.raises(MigrationError) as excinfo:
+        migration_manager.start(serial_number)
+    assert excinfo.value.status_code == 500
+    assert fleet.tags[serial_number] == ["ready"]
+    # same outcome as start_many
+    result = migration_manager.start_many([serial_number])[0]
+    assert result["status_code"] == 500
+    assert fleet.tags[serial_number] == ["ready"]
+
+
+def test_start(migration_manager, fleet):
+    serial_number = fleet.serial_numbers[0]
+    migration_manager.start(serial_number)
+    assert fleet.tags[serial_number] == ["started"]
+    assert not fleet.mdm_capable[serial_number]
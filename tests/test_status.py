@@ -0,0 +1,38 @@
+import time
+
+
+def test_probe_status_bounded_by_deadline(make_migration_manager, fleet, jamf_server):
+    mm = make_migration_manager(status_timeout=1)
+    serial_number = fleet.serial_numbers[0]
+    fleet.tags[serial_number] = ["started"]
+    # warm up the token before the errors
+    mm.jamf_client.refresh_access_token_if_necessary()
+    # the 500 responses are retried with a backoff
+    jamf_server.error_rate = 1
+    ended_at = []
+    get_mdm_status = mm.jamf_client.get_mdm_status
+
+    def timed_get_mdm_status(serial_number):
+        try:
+            return get_mdm_status(serial_number)
+        finally:
+            ended_at.append(time.monotonic())
+
+    mm.jamf_client.get_mdm_status = timed_get_mdm_status
+    start = time.monotonic()
+    result = mm.status(serial_number)
+    assert result["jamf_status"] in ("timeout", "error")
+    assert result["zentral_status"] == "enrolled"
+    # the abandoned Jamf probe stops at the deadline, not after all the retries
+    deadline = time.monotonic() + 5
+    while not ended_at and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert ended_at[0] - start < 2
+    assert jamf_server.counts["GET computer"] < 4
+
+
+def test_status_without_timeout(migration_manager, fleet):
+    serial_number = fleet.serial_numbers[0]
+    fleet.mdm_capable[serial_number] = False
+    assert migration_manager.status(serial_number) == {"jamf_status": "unenrolled", "zentral_status": "enrolled"}
+    assert fleet.tags[serial_number] == ["unenrolled"]
@@ -0,0 +1,106 @@
+import time
+from nekobus.throttling import BackendGovernor, parse_retry_after
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("2") == 2
+    assert parse_retry_after("-1") == 0
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert parse_retry_after("yolo") is None
+
+
+def test_concurrent_429_single_decrease():
+    governor = BackendGovernor("test", max_rate=200, max_concurrency=10)
+    sent_ats = [governor.acquire() for _ in range(10)]
+    for sent_at in sent_ats:
+        governor.release(FakeResponse(429), sent_at)
+    metrics = governor.metrics()
+    assert metrics["rate"] == 100
+    assert metrics["concurrency_limit"] == 5
+    assert metrics["throttled_count"] == 10
+    assert metrics["decrease_count"] == 1
+    assert metrics["in_flight"] == 0
+
+
+def test_429_after_decrease():
+    governor = BackendGovernor("test", max_rate=200, max_concurrency=10)
+    governor.release(FakeResponse(429), governor.acquire())
+    # sent after the first decrease, new congestion event
+    governor.release(FakeResponse(429), governor.acquire())
+    assert governor.metrics()["rate"] == 50
+    assert governor.metrics()["decrease_count"] == 2
+
+
+def test_429_without_send_time():
+    governor = BackendGovernor("test", max_rate=200, max_concurrency=10)
+    governor.acquire()
+    governor.acquire()
+    governor.release(FakeResponse(429))
+    governor.release(FakeResponse(429))
+    assert governor.metrics()["decrease_count"] == 2
+
+
+def test_retry_after_blocks():
+    governor = BackendGovernor("test", max_rate=200, max_concurrency=10)
+    sent_at = governor.acquire()
+    governor.release(FakeResponse(429, {"Retry-After": "30"}), sent_at)
+    assert governor.blocked_until - sent_at >= 30
+
+
+def test_increase_constant_step_per_interval():
+    governor = BackendGovernor("test", max_rate=200, max_concurrency=10)
+    governor.release(FakeResponse(429), governor.acquire())
+    governor.release(FakeResponse(429), governor.acquire())
+    assert governor.metrics()["rate"] == 50
+    # interval not elapsed
+    for _ in range(100):
+        governor.release(FakeResponse(200), governor.acquire())
+    assert governor.metrics()["rate"] == 50
+    governor.increase_interval = 0
+    governor.release(FakeResponse(200), governor.acquire())
+    metrics = governor.metrics()
+    assert metrics["rate"] == 70
+    assert metrics["concurrency_limit"] == 3
+    for _ in range(20):
+        governor.release(FakeResponse(200), governor.acquire())
+    metrics = governor.metrics()
+    assert metrics["rate"] == 200
+    assert metrics["concurrency_limit"] == 10
+
+
+def test_server_errors_ignored():
+    governor = BackendGovernor("test", max_rate=200, max_concurrency=10)
+    governor.release(FakeResponse(500), governor.acquire())
+    assert governor.metrics()["rate"] == 200
+    assert governor.metrics()["decrease_count"] == 0
+
+
+def test_acquire_deadline():
+    governor = BackendGovernor("test", max_rate=200, max_concurrency=1)
+    governor.acquire()
+    start = time.monotonic()
+    assert governor.acquire(deadline=time.monotonic() + 0.1) is None
+    assert time.monotonic() - start < 1
+    governor.release()
+    # blocked past the deadline
+    governor.release(FakeResponse(429, {"Retry-After": "10"}), governor.acquire())
+    assert governor.acquire(deadline=time.monotonic() + 1) is None
+    assert governor.metrics()["in_flight"] == 0
+
+
+def test_acquire_rate_deadline():
+    governor = BackendGovernor("test", max_rate=1, max_concurrency=10)
+    governor.release(None, governor.acquire())
+    # next token in 1 second
+    start = time.monotonic()
+    assert governor.acquire(deadline=time.monotonic() + 0.1) is None
+    assert time.monotonic() - start < 0.1
+    assert governor.metrics()["in_flight"] == 0
+    assert governor.acquire(deadline=time.monotonic() + 2) is not None
@@ -0,0 +1,77 @@
+def checkin_payload(serial_number):
+    return {
+        "webhook": {"id": 1, "name": "Check-in", "webhookEvent": "ComputerCheckIn"},
+        "event": {"computer": {"serialNumber": serial_number, "jssID": 1}, "trigger": "CLIENT_CHECKIN"},
+    }
+
+
+def push_capability_payload(serial_number):
+    return {
+        "webhook": {"id": 2, "name": "Push", "webhookEvent": "ComputerPushCapabilityChanged"},
+        "event": {"serialNumber": serial_number, "jssID": 1},
+    }
+
+
+def test_started_device_unenrolled(make_migration_manager, fleet):
+    serial_number = fleet.serial_numbers[0]
+    fleet.tags[serial_number] = ["started"]
+    fleet.mdm_capable[serial_number] = False
+    # the webhook is received by another process than the one that started the device
+    result = make_migration_manager().process_jamf_webhook(checkin_payload(serial_number))
+    assert result["migration_tags"] == ["unenrolled"]
+    assert fleet.tags[serial_number] == ["unenrolled"]
+
+
+def test_started_device_still_enrolled(migration_manager, fleet):
+    serial_number = fleet.serial_numbers[0]
+    fleet.tags[serial_number] = ["started"]
+    result = migration_manager.process_jamf_webhook(push_capability_payload(serial_number))
+    assert result["migration_tags"] == ["started"]
+    assert fleet.tags[serial_number] == ["started"]
+
+
+def test_not_started_device_not_verified(migration_manager, fleet, jamf_server):
+    serial_number = fleet.serial_numbers[0]
+    fleet.mdm_capable[serial_number] = False
+    result = migration_manager.process_jamf_webhook(checkin_payload(serial_number))
+    assert result["migration_tags"] == ["ready"]
+    assert fleet.tags[serial_number] == ["ready"]
+    assert jamf_server.counts["GET computer"] == 0
+
+
+def test_unknown_event_ignored(migration_manager, fleet, jamf_server, zentral_server):
+    serial_number = fleet.serial_numbers[0]
+    fleet.tags[serial_number] = ["started"]
+    fleet.mdm_capable[serial_number] = False
+    payload = checkin_payload(serial_number)
+    payload["webhook"]["webhookEvent"] = "ComputerCommandCompleted"
+    result = migration_manager.process_jamf_webhook(payload)
+    assert "migration_tags" not in result
+    assert fleet.tags[serial_number] == ["started"]
+    assert sum(jamf_server.counts.values()) == 0
+    assert sum(zentral_server.counts.values()) == 0
+
+
+def test_status_skips_jamf_for_unenrolled_device(make_migration_manager, fleet, jamf_server):
+    serial_number = fleet.serial_numbers[0]
+    fleet.tags[serial_number] = ["started"]
+    fleet.mdm_capable[serial_number] = False
+    make_migration_manager().process_jamf_webhook(checkin_payload(serial_number))
+    assert jamf_server.counts["GET computer"] == 1
+    result = make_migration_manager(jamf_webhooks=True).status(serial_number)
+    assert result["jamf_status"] == "unenrolled"
+    assert jamf_server.counts["GET computer"] == 1
+    # concurrent probes, the Jamf status is discarded
+    fleet.mdm_capable[serial_number] = True
+    result = make_migration_manager(jamf_webhooks=True, status_timeout=5).status(serial_number)
+    assert result["jamf_status"] == "unenrolled"
+
+
+def test_status_without_webhooks_ignores_tags(make_migration_manager, fleet, jamf_server, zentral_server):
+    serial_number = fleet.serial_numbers[0]
+    fleet.tags[serial_number] = ["unenrolled"]
+    for i, mm in enumerate((make_migration_manager(), make_migration_manager(status_timeout=5))):
+        result = mm.status(serial_number)
+        assert result["jamf_status"] == "enrolled"
+        assert jamf_server.counts["GET computer"] == i + 1
+    assert zentral_server.counts["GET machine_meta"] == 0
@@ -0,0 +1,60 @@
+import threading
+import time
+from nekobus.zentral import ZentralClientError
+
+
+def test_mdm_status_missing_from_index(make_migration_manager, fleet, zentral_server):
+    mm = make_migration_manager(mdm_enrolled_device_index_ttl=60)
+    zentral_client = mm.zentral_client
+    serial_number, other_serial_number = fleet.serial_numbers[:2]
+    assert zentral_client.get_mdm_status(serial_number) == "enrolled"
+    assert zentral_server.counts["GET mdm_devices"] == 1
+    # enrolled since the last sync, not found until the next refresh
+    del zentral_client.mdm_enrolled_device_index._index[other_serial_number]
+    assert zentral_client.get_mdm_status(other_serial_number) == "not_found"
+    assert zentral_client.get_mdm_status("UNKNOWN0001") == "not_found"
+    assert zentral_server.counts["GET mdm_devices"] == 1
+    zentral_client.mdm_enrolled_device_index.refresh(force=True)
+    assert zentral_client.get_mdm_status(other_serial_number) == "enrolled"
+    assert zentral_server.counts["GET mdm_devices"] == 2
+
+
+def test_mdm_status_index_error(make_migration_manager, fleet, monkeypatch):
+    mm = make_migration_manager(mdm_enrolled_device_index_ttl=60)
+    zentral_client = mm.zentral_client
+
+    def failing_iter_results(path, params=None):
+        raise ZentralClientError("yolo")
+
+    monkeypatch.setattr(zentral_client, "iter_results", failing_iter_results)
+    assert zentral_client.get_mdm_status(fleet.serial_numbers[0]) == "enrolled"
+
+
+def test_index_refresh_does_not_block_readers(make_migration_manager, fleet, monkeypatch):
+    mm = make_migration_manager(mdm_enrolled_device_index_ttl=60)
+    zentral_client = mm.zentral_client
+    index = zentral_client.mdm_enrolled_device_index
+    serial_number = fleet.serial_numbers[0]
+    assert index.get_status(serial_number) == "enrolled"
+    iter_results = zentral_client.iter_results
+    paging = threading.Event()
+    resume = threading.Event()
+
+    def slow_iter_results(path, params=None):
+        paging.set()
+        resume.wait(5)
+        yield from iter_results(path, params)
+
+    monkeypatch.setattr(zentral_client, "iter_results", slow_iter_results)
+    index._synced_at -= index.ttl
+    refresh_thread = threading.Thread(target=index.refresh)
+    refresh_thread.start()
+    try:
+        assert paging.wait(5)
+        # the current index is used during the refresh
+        t0 = time.monotonic()
+        assert index.get_status(serial_number) == "enrolled"
+        assert time.monotonic() - t0 < 1
+    finally:
+        resume.set()
+        refresh_thread.join()